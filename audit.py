@@ -0,0 +1,971 @@
+"""
+The verification stages
+
+The verify_* functions check the data they are given, write the report of their
+script ending with the fingerprints they are given, and fail with an AssertionError.
+
+An AuditContext loads the files of a data directory as they are needed, once,
+and the stage functions at the end run each verify_* function on a context.
+The meeting scripts are each one of these, and audit_all.py runs them all
+on the same data directory.
+"""
+
+import os, itertools
+import base, data, filenames, commitment, batch, codes
+
+##
+## the opened ballots, checked in shards over the worker processes
+##
+
+def verify_ballot_shard(shard):
+  """
+  check a shard of opened ballots, the form base.parallel_map hands out:
+  (constant, election, items), each item being (committed ballot, opened ballot, P table row or None).
+  The codes are checked, and the votes against the p3 column of the row when there is one.
+
+  Returns, for each item in order, the reason the ballot doesn't verify (None if it does)
+  and the list of (question_id, symbol_id, confirmation_code) it reveals.
+  """
+  constant, election, items = shard
+
+  # all the commitments of the shard are checked in one batch
+  openings = []
+  ballot_openings = []
+  for ballot, opened_ballot, p_row in items:
+    try:
+      these_openings, codes = ballot.code_openings(opened_ballot)
+    except KeyError:
+      # a question or symbol that isn't on the printed ballot
+      these_openings, codes = None, []
+    start = len(openings)
+    openings += these_openings or []
+    ballot_openings.append((start, len(openings), codes, these_openings is not None))
+  openings_ok = commitment.verify_many(openings, constant)
+
+  reasons = []
+  for (ballot, opened_ballot, p_row), (start, stop, codes, on_ballot) in zip(items, ballot_openings):
+    if not on_ballot:
+      reasons.append("reveals codes that aren't on its printed ballot")
+    elif ballot.pid != opened_ballot.pid:
+      reasons.append("doesn't match its printed ballot")
+    elif not all(openings_ok[start:stop]):
+      reasons.append("bad code openings")
+    else:
+      reasons.append(None)
+
+  # the votes of the ballots with good codes, all checked together against their P table rows
+  plan_choices = election.partition_plan_choices
+  encoding_failures = set(data.encoding_failures(election, [(opened_ballot, plan_choices.split(p_row['p3']))
+                                                            for (ballot, opened_ballot, p_row), reason in zip(items, reasons)
+                                                            if p_row is not None and reason is None]))
+
+  results = []
+  for (ballot, opened_ballot, p_row), reason, (start, stop, codes, on_ballot) in zip(items, reasons, ballot_openings):
+    if reason is None and opened_ballot.pid in encoding_failures:
+      reason = "votes don't match the P table"
+    results.append((reason, codes))
+
+  return results
+
+def verify_ballot_openings(election, ballots, opened_ballots, p_table=None, code_callback_func=None, workers=None, already_verified=None):
+  """
+  check the code openings of the opened ballots against the printed ballots and,
+  when a P table is given, that the votes of each opened ballot are its P table row.
+
+  The ballots are checked in shards over workers processes (base.WORKERS by default).
+  The code_callback_func, as in Ballot.verify_code_openings, is then called in this
+  process for each ballot that verifies, in the order of opened_ballots, so the codes
+  come out the same as checking the ballots one by one.
+
+  The ballots whose pids are in already_verified are taken as verified, and only
+  their codes are read off them, in the same order as the check does.
+
+  Returns the list of (pid, webSerial, reason) of the ballots that don't verify.
+  """
+  if already_verified is None:
+    already_verified = set()
+
+  failures = []
+
+  # each opened ballot in order, with whether it is checked now
+  entries = []
+  items = []
+  for opened_ballot in opened_ballots.values():
+    if opened_ballot.pid in already_verified:
+      entries.append((opened_ballot, False))
+      continue
+
+    if not ballots.has_key(opened_ballot.pid):
+      failures.append((opened_ballot.pid, opened_ballot.webSerial, "isn't a printed ballot"))
+      continue
+
+    p_row = None
+    if p_table is not None:
+      if not p_table.rows.has_key(opened_ballot.pid):
+        failures.append((opened_ballot.pid, opened_ballot.webSerial, "isn't in the P table"))
+        continue
+      p_row = p_table.rows[opened_ballot.pid]
+
+    entries.append((opened_ballot, True))
+    items.append((ballots[opened_ballot.pid], opened_ballot, p_row))
+
+  chunks = base.chunks(items, base.CHUNK_SIZE)
+  shards = [(election.constant, election, chunk) for chunk in chunks]
+
+  # the results of the ballots checked now, dealt with as soon as their shard comes in
+  results = itertools.chain.from_iterable(base.parallel_imap(verify_ballot_shard, shards, workers))
+  for opened_ballot, checked in entries:
+    if checked:
+      reason, ballot_codes = results.next()
+      if reason:
+        failures.append((opened_ballot.pid, opened_ballot.webSerial, reason))
+        continue
+    else:
+      ballot_codes = [(q_id, s_id, s['code']) for q_id, q in opened_ballot.questions.iteritems() for s_id, s in q.iteritems()]
+
+    if code_callback_func:
+      for q_id, s_id, code in ballot_codes:
+        code_callback_func(opened_ballot.webSerial, opened_ballot.pid, q_id, s_id, code)
+
+  return failures
+
+def write_codes(code_export, codes_output_stream=None, codes_index_path=None):
+  """
+  write the codes of a codes.CodeExport to the codes file and to the index, those that are given
+  """
+  if codes_output_stream:
+    code_export.write(codes_output_stream)
+  if codes_index_path:
+    code_export.write_index(codes_index_path)
+  code_export.close()
+
+def ballot_failures_report(failures):
+  return "some ballots don't verify:\n" + "\n".join(["ballot pid %s, web serial %s: %s" % failure for failure in failures])
+
+##
+## meeting 1
+##
+
+def verify_meeting_one(output_stream, fingerprints, election, p_table, partitions):
+  # check that there are as many ballots in the P table as claimed
+  assert len(p_table.rows) == election.num_ballots, "P Table has the wrong number of ballots, should be %s " % election.num_ballots
+
+  num_d_tables = None
+
+  # loop through partitions
+  for p_id, partition in partitions.iteritems():
+    this_num_d_tables = len(partition.values())
+
+    # check that it's the same number of D tables
+    if num_d_tables:
+      assert this_num_d_tables == num_d_tables
+    else:
+      num_d_tables = this_num_d_tables
+
+    # loop through d tables for that partition
+    for d_table_id, d_table in partition.iteritems():
+      # check that it has the right number of ballots
+      assert len(d_table.rows) == election.num_ballots, "D Table %s in partition %s has the wrong number of ballots, should be %s" % (d_table_id, p_id, election.num_ballots)
+
+  output_stream.write("""Election ID: %s
+Meeting 1 Successful
+
+%s Ballots
+Partitions: %s
+%s D-Tables
+
+%s
+""" % (election.spec.id, election.num_ballots, partitions.keys(), num_d_tables, base.fingerprint_report(fingerprints)))
+
+##
+## meeting 2
+##
+
+def verify_open_p_and_d_tables(election, committed_p_table, committed_partitions, open_p_table, open_partitions, workers=None):
+  """
+  the commitment checks are most of the work, so they are collected first in shards:
+  the P table rows, then each (partition, instance) pair, each of them cut in chunks of rows.
+  The shards are verified over workers processes (base.WORKERS by default), and the
+  result is the same as checking the rows one by one.
+  """
+  shards = []
+
+  # P table commitments
+  p_openings = []
+  for row_id in sorted(open_p_table.rows.keys()):
+    p_openings += committed_p_table.full_row_openings(open_p_table.rows[row_id])
+  shards += base.chunks(p_openings, 2 * base.CHUNK_SIZE)
+
+  # D table commitments, both sides of every revealed row
+  for p_id in sorted(committed_partitions.keys()):
+    for d_table_id in sorted(committed_partitions[p_id].keys()):
+      d_table = committed_partitions[p_id][d_table_id]
+      response_d_table = open_partitions[p_id][d_table_id]
+      d_openings = []
+      for row_id in sorted(response_d_table.rows.keys()):
+        d_openings += d_table.full_row_openings(p_id, d_table_id, response_d_table.rows[row_id])
+      shards += base.chunks(d_openings, 2 * base.CHUNK_SIZE)
+
+  results = base.parallel_map(commitment.verify_shard, [(shard, election.constant) for shard in shards], workers)
+  if not all([all(result) for result in results]):
+    return False
+
+  # Now we go through the partitions, the d tables within each partition,
+  # and we look at the rows that are revealed. As we do this, we'll also
+  # spot check that the permutations in a given d_table row match the p_table rows revealed
+
+  # first we get the partition-and-question map for this election, which
+  # is effectively a tree representation of how the questions are grouped
+  # in partitions, with each leaf being the number of answers for that given question.
+  # Its plan says where each partition sits in the concatenated P table permutations,
+  # and where each question sits within its partition
+  partition_plan = election.partition_plan
+
+  # the list of p table rows that are opened up
+  p_table_row_ids = sorted(open_p_table.rows.keys())
+
+  # loop through partitions
+  for p_id, partition in committed_partitions.iteritems():
+    # loop through d tables for that partition
+    for d_table_id, d_table in partition.iteritems():
+      # get the corresponding response D table
+      response_d_table = open_partitions[p_id][d_table_id]
+
+      # we check that
+      # (1) the responses are correct according to the commitments, done above
+      # (2) the D table rows revealed are those of the P table rows revealed, one each,
+      # which the pid index of the D table joins them by
+
+      # (2) one D table row per P table row
+      if response_d_table.duplicate_pids or response_d_table.duplicate_rids:
+        print "D table %s in partition %s reveals more than one row for pids %s, rids %s" % (d_table_id, p_id, response_d_table.duplicate_pids, response_d_table.duplicate_rids)
+        return False
+
+      missing_pids = [pid for pid in p_table_row_ids if not response_d_table.by_pid.has_key(pid)]
+      if missing_pids or len(response_d_table.rows) != len(p_table_row_ids):
+        print "D table %s in partition %s doesn't reveal the rows of the P table rows revealed, missing pids %s" % (d_table_id, p_id, missing_pids)
+        return False
+
+      # (3) permutations, checked on all the rows of this D table at once:
+      # on the d table, just d2 then d4 to go from coded to decoded,
+      # the composition of the print tables is p_2 o p_1_inv to go from coded to decoded
+      row_ids = [response_d_table.by_pid[pid] for pid in p_table_row_ids]
+      d_rows = [response_d_table.rows[row_id] for row_id in row_ids]
+
+      # the corresponding P table rows, only the part that covers this partition
+      start, stop = partition_plan.bounds[p_id]
+      p_rows = [open_p_table.rows[pid] for pid in p_table_row_ids]
+
+      failing = batch.check_compositions(batch.stack([d_row['d2'] for d_row in d_rows]), batch.stack([d_row['d4'] for d_row in d_rows]),
+                                         batch.stack([p_row['p1'][start:stop] for p_row in p_rows]), batch.stack([p_row['p2'][start:stop] for p_row in p_rows]),
+                                         partition_plan.parts[p_id].leaves)
+      if failing:
+        print "D table %s in partition %s doesn't match the P table permutations, rows %s" % (d_table_id, p_id, [row_ids[i] for i in failing])
+        return False
+
+  # if we make it to here, it's good
+  return True
+
+def verify_meeting_two(output_stream, fingerprints, election, p_table, partitions, challenge_p_table, response_p_table, response_partitions, random_data, workers=None):
+  challenge_row_ids = challenge_p_table.rows.keys()
+
+  # check the generation of the challenge rows
+  # we assume that the length of the challenge list is the right one
+  challenge_row_ids_ints = set([int(c) for c in challenge_row_ids])
+  challenges_match_randomness = False
+  seed = random_data + election.constant
+  regenerate_row_ids_ints = set(base.generate_random_int_list(seed, election.num_ballots, len(challenge_row_ids)))
+
+  if challenge_row_ids_ints == regenerate_row_ids_ints:
+    challenges_match_randomness = True
+  else:
+    # the report says so, these are the details
+    output_stream.write("Challenges Don't Match Randomness:\n")
+    output_stream.write(" challenge_row_ids_ints: %s\n" % challenge_row_ids_ints)
+    output_stream.write(" generate_random_int_list: %s\n" % regenerate_row_ids_ints)
+    output_stream.write(" diff: %s\n" % (regenerate_row_ids_ints ^ challenge_row_ids_ints))
+
+  # check that the open P table rows match the challenge
+  assert sorted(challenge_row_ids) == sorted([r['id'] for r in response_p_table.rows.values()]), "challenges don't match revealed row IDs in P table"
+
+  # check that the P and D tables are properly revealed
+  assert verify_open_p_and_d_tables(election, p_table, partitions, response_p_table, response_partitions, workers), "bad reveal of P and D tables"
+
+  output_stream.write("""Election ID: %s
+Meeting 2 Successful
+
+%s ballots challenged and answered successfully.
+
+Challenges Match Randomness? %s
+
+%s
+
+""" % (election.spec.id, len(challenge_row_ids), str(challenges_match_randomness).upper(), base.fingerprint_report(fingerprints)))
+
+##
+## meeting 3
+##
+
+def verify_meeting_three(output_stream, fingerprints, election, challenge_row_ids, ballots, p_table_votes, ballots_with_codes, codes_output_stream=None, codes_index_path=None,
+                         workers=None, already_verified=None, delta_report=""):
+  """
+  already_verified and delta_report are for verify_meeting_three_delta
+  """
+  # make sure none of the actual votes use ballots that were audited in Meeting2:
+  assert set(p_table_votes.rows.keys()).isdisjoint(set(challenge_row_ids))
+
+  if codes_output_stream or codes_index_path:
+    code_export = codes.CodeExport()
+    new_code = code_export.new_code
+  else:
+    code_export, new_code = None, None
+
+  # check the openings, and that the coded votes correspond to the confirmation code openings
+  failures = verify_ballot_openings(election, ballots, ballots_with_codes, p_table_votes, new_code, workers, already_verified)
+  assert not failures, ballot_failures_report(failures)
+
+  # we get the half-decrypted votes, but there's nothing to verify yet
+
+  # we write out the codes
+  if code_export:
+    write_codes(code_export, codes_output_stream, codes_index_path)
+
+  # we get the R table, and that can be tallied based on the type of question
+  # however, just to separate the cryptographic verification from the actual
+  # counting, which should be a lot simpler, the counting of the R table is done
+  # in the tally.py program.
+
+  output_stream.write("""Election ID: %s
+Meeting 3 Successful
+
+%s ballots cast
+%s
+The tally can now be computed, not fully verified yet, using tally.py
+
+%s
+""" % (election.spec.id, len(ballots_with_codes), delta_report, base.fingerprint_report(fingerprints)))
+
+def verify_meeting_three_delta(output_stream, fingerprints, regular_fingerprints, election, challenge_row_ids, ballots,
+                               regular_p_table_votes, regular_ballots_with_codes, p_table_votes, ballots_with_codes,
+                               codes_output_stream=None, codes_index_path=None, workers=None):
+  """
+  meeting 3 with the provisional ballots added, checking only what meeting 3 on the regular
+  files doesn't: the ballots with codes are matched to the regular ones by pid, and those
+  in both must be the same there, with the same P table row, or the audit fails.
+  The code openings and the votes of the others, the new ones, are then checked as usual.
+
+  This relies on meeting3.py verifying the regular files, whose fingerprints the report adds.
+  """
+  failures = []
+  shared_pids = set()
+  for regular_ballot in regular_ballots_with_codes.values():
+    pid = regular_ballot.pid
+    if not ballots_with_codes.has_key(pid):
+      failures.append((pid, regular_ballot.webSerial, "isn't with the provisional ballots"))
+    elif vars(ballots_with_codes[pid]) != vars(regular_ballot):
+      failures.append((pid, regular_ballot.webSerial, "isn't the same with the provisional ballots"))
+    elif p_table_votes.rows.get(pid) != regular_p_table_votes.rows.get(pid):
+      failures.append((pid, regular_ballot.webSerial, "has another P table row with the provisional ballots"))
+    elif p_table_votes.rows.has_key(pid):
+      shared_pids.add(pid)
+  assert not failures, ballot_failures_report(failures)
+
+  delta_report = """Delta mode: %s ballots are the same as in the regular meeting 3 files, which meeting3.py verifies,
+only the other %s were checked here
+""" % (len(shared_pids), len(ballots_with_codes) - len(shared_pids))
+
+  verify_meeting_three(output_stream, fingerprints + [["Regular " + label, fingerprint] for label, fingerprint in regular_fingerprints],
+                       election, challenge_row_ids, ballots, p_table_votes, ballots_with_codes,
+                       codes_output_stream, codes_index_path, workers, shared_pids, delta_report)
+
+##
+## ballots opened after meeting 3
+##
+
+def verify_contested_ballots(output_stream, fingerprints, election, ballots, cast_ballots, contested_ballots, codes_output_stream=None, codes_index_path=None,
+                             workers=None):
+  if codes_output_stream:
+    codes_output_stream.write('Serial #,P-table ID')
+    for q_id in sorted(contested_ballots.values()[0].questions.keys()):
+      codes_output_stream.write(",question %s"%q_id)
+    codes_output_stream.write("\n")
+
+  # is each of them a cast ballot?
+  failures = [(contested_ballot.pid, contested_ballot.webSerial, "isn't a cast ballot")
+              for contested_ballot in contested_ballots.values() if not cast_ballots.has_key(contested_ballot.pid)]
+
+  # does it verify against the original ballots
+  failures += verify_ballot_openings(election, ballots, contested_ballots, workers=workers)
+  assert not failures, ballot_failures_report(failures)
+
+  if codes_output_stream:
+    for contested_ballot in contested_ballots.values():
+      codes_output_stream.write('%s,%s' % (contested_ballot.webSerial, contested_ballot.pid))
+      for q_id in sorted(contested_ballot.questions.keys()):
+        codes_output_stream.write(',"%s"' % ",".join([q['code'] for q in contested_ballot.questions[q_id].values()]))
+      codes_output_stream.write("\n")
+
+  # the index has the same codes, by web serial number
+  if codes_index_path:
+    code_export = codes.CodeExport()
+    for contested_ballot in contested_ballots.values():
+      for q_id, question in contested_ballot.questions.iteritems():
+        for s_id, symbol in question.iteritems():
+          code_export.new_code(contested_ballot.webSerial, contested_ballot.pid, q_id, s_id, symbol['code'])
+    write_codes(code_export, None, codes_index_path)
+
+  # go through the contested ballots
+  output_stream.write("""Election ID: %s
+Contested Ballots Audit Successful
+
+%s ballots contested and opened successfully
+
+%s
+""" % (election.spec.id, len(contested_ballots.keys()), base.fingerprint_report(fingerprints)))
+
+def verify_opened_ballots(election, p_table, partitions, ballots, opened_ballots, opened_p_table, opened_partitions, codes_output_stream=None, codes_index_path=None,
+                          workers=None):
+  """
+  the ballots that were opened whole, spoiled or unused: their codes
+  and the reveal of their P and D table rows
+  """
+  if codes_output_stream or codes_index_path:
+    code_export = codes.CodeExport()
+    new_code = code_export.new_code
+  else:
+    code_export, new_code = None, None
+
+  # check codes, does each ballot verify against the original ballots
+  failures = verify_ballot_openings(election, ballots, opened_ballots, code_callback_func = new_code, workers = workers)
+  assert not failures, ballot_failures_report(failures)
+
+  # we just verify that the D and P tables are opened properly
+  # same as meeting2, only without a specific challenge set
+  assert verify_open_p_and_d_tables(election, p_table, partitions, opened_p_table, opened_partitions, workers), "bad reveal of P and D tables"
+
+  # we write out the codes
+  if code_export:
+    write_codes(code_export, codes_output_stream, codes_index_path)
+
+def verify_spoiled_ballots(output_stream, fingerprints, election, p_table, partitions, ballots, spoiled_ballots, spoiled_p_table, spoiled_partitions, codes_output_stream=None, codes_index_path=None,
+                           workers=None):
+  verify_opened_ballots(election, p_table, partitions, ballots, spoiled_ballots, spoiled_p_table, spoiled_partitions, codes_output_stream, codes_index_path, workers)
+
+  output_stream.write("""Election ID: %s
+Spoiled Ballots Audit Successful
+
+%s ballots spoiled and opened successfully
+
+%s
+""" % (election.spec.id, len(spoiled_ballots.keys()), base.fingerprint_report(fingerprints)))
+
+def verify_unused_ballots(output_stream, fingerprints, election, p_table, partitions, ballots, unused_ballots, unused_p_table, unused_partitions, codes_output_stream=None,
+                          workers=None):
+  verify_opened_ballots(election, p_table, partitions, ballots, unused_ballots, unused_p_table, unused_partitions, codes_output_stream, None, workers)
+
+  output_stream.write("""Election ID: %s
+Unused Ballots Audit Successful
+
+%s ballots opened successfully
+
+%s
+""" % (election.spec.id, len(unused_ballots.keys()), base.fingerprint_report(fingerprints)))
+
+##
+## meeting 4
+##
+
+def d_row_failures_report(failures):
+  return "some challenged rows don't verify:\n" + "\n".join(["D table %s in partition %s, row %s: %s" % (instance_id, p_id, row_id, reason)
+                                                            for p_id, instance_id, row_id, reason in failures])
+
+def verify_meeting_four(output_stream, fingerprints, election, d_table_commitments, already_open_d_tables, p_table_votes,
+                        cast_ballot_partitions, r_tables_by_partition, d_table_challenges, d_table_responses, random_data, workers=None):
+  """
+  the challenged rows are grouped by D table and by the side they are opened on.
+  The commitments of all the groups are checked in shards over workers processes
+  (base.WORKERS by default), then the permutations of each group all at once,
+  with batch.check_gathers. A row that doesn't verify is listed with the reason.
+  """
+  # verify that challenges are appropriately generated
+  challenges_match_randomness = True
+
+  # we assume that one D table always opens on the same side
+  # we do a bit of an odd thing here to keep the partitions and d tables in order
+  # because that's how counter is decided
+  d_tables_in_order = []
+  for p_id in sorted(cast_ballot_partitions.keys()):
+    # get the D tables ordered by their integer ID
+    for d_table in data.sort_by_id(cast_ballot_partitions[p_id].values()):
+      d_tables_in_order.append((p_id, d_table.id))
+
+  seed = random_data + election.constant
+
+  # which side is each d table opened on? the counter is its place in the order
+  sides = base.prng_many(seed, range(len(d_tables_in_order)), 2)
+
+  # a dictionary of partition_ids, with values a dictionary of d_table ID
+  expected_challenge_sides = {}
+  for (p_id, instance_id), side in zip(d_tables_in_order, sides):
+    expected_challenge_sides.setdefault(p_id, {})[instance_id] = ("LEFT","RIGHT")[side]
+
+  partition_plan = election.partition_plan
+  partition_plan_choices = election.partition_plan_choices
+
+  failures = []
+
+  # the challenged rows by (partition, instance, side), and the commitment openings they reveal
+  groups = []
+  openings = []
+  for p_id in sorted(d_table_challenges.keys()):
+    for instance_id in sorted(d_table_challenges[p_id].keys()):
+      d_table_challenge = d_table_challenges[p_id][instance_id]
+      d_table = d_table_commitments[p_id][instance_id]
+      d_table_response = d_table_responses[p_id][instance_id]
+
+      # check that the open rows now are disjoint from the open rows before
+      assert set(d_table_challenge.rows.keys()).isdisjoint(set(already_open_d_tables[p_id][instance_id].rows.keys())), 'some challenges repeat the challenges from meeting2'
+
+      # the rows revealed link to different P and R table rows
+      assert not (d_table_response.duplicate_pids or d_table_response.duplicate_rids), "D table %s in partition %s reveals more than one row for pids %s, rids %s" % (instance_id, p_id, d_table_response.duplicate_pids, d_table_response.duplicate_rids)
+
+      rows_by_side = {'LEFT': [], 'RIGHT': []}
+      for row_id in sorted(d_table_challenge.rows.keys()):
+        row = d_table_challenge.rows[row_id]
+
+        # does it match the randomness?
+        if row['side'] != expected_challenge_sides[p_id][instance_id]:
+          challenges_match_randomness = False
+
+        # response row
+        response_row = d_table_response.rows.get(row_id)
+        if response_row is None:
+          failures.append((p_id, instance_id, row_id, "isn't revealed"))
+        elif not d_table.rows.has_key(row_id):
+          failures.append((p_id, instance_id, row_id, "isn't in the committed D table"))
+        else:
+          if row['side'] == 'LEFT':
+            side, opening = 'LEFT', d_table.cl_opening
+          else:
+            side, opening = 'RIGHT', d_table.cr_opening
+          try:
+            rows_by_side[side].append((row_id, response_row, opening(p_id, instance_id, response_row)))
+          except ValueError:
+            # a permutation entry that can't even be committed to
+            failures.append((p_id, instance_id, row_id, "bad opening of the %s commitment" % side.lower()))
+
+      for side in ('LEFT', 'RIGHT'):
+        rows = rows_by_side[side]
+        if rows:
+          groups.append((p_id, instance_id, side, rows, len(openings)))
+          openings += [opening for row_id, response_row, opening in rows]
+
+  # check proper reveal, of all the groups at once
+  openings_ok = []
+  for shard_ok in base.parallel_map(commitment.verify_shard, [(shard, election.constant) for shard in base.chunks(openings, base.CHUNK_SIZE)], workers):
+    openings_ok += shard_ok
+
+  for p_id, instance_id, side, rows, first_opening in groups:
+    cast_ballot_d_table = cast_ballot_partitions[p_id][instance_id]
+    r_table = r_tables_by_partition[p_id]
+    perm_plan = partition_plan.parts[p_id]
+    choices_plan = partition_plan_choices.parts[p_id]
+    start, stop = partition_plan_choices.bounds[p_id]
+
+    # for each row, its permutation, the choices it takes, and what they should come to
+    row_ids, perms, choices, results = [], [], [], []
+    for i, (row_id, response_row, opening) in enumerate(rows):
+      if not openings_ok[first_opening + i]:
+        failures.append((p_id, instance_id, row_id, "bad opening of the %s commitment" % side.lower()))
+        continue
+
+      # partially decrypted choices, d3 out of d2,d3,d4
+      cast_ballot_row = cast_ballot_d_table.rows.get(row_id)
+      if cast_ballot_row is None:
+        failures.append((p_id, instance_id, row_id, "isn't in the cast ballots D table"))
+        continue
+
+      if side == 'LEFT':
+        # d2 takes the corresponding P3 choices (index 2, then partition) to d3
+        p_row = p_table_votes.rows.get(response_row['pid'])
+        if p_row is None:
+          failures.append((p_id, instance_id, row_id, "its pid %s isn't in the cast ballots P table" % response_row['pid']))
+          continue
+        perm, choice, result = response_row['d2'], p_row['p3'][start:stop], cast_ballot_row['d3']
+      else:
+        # d4 takes d3 to the corresponding R table choices
+        r_row = r_table.rows.get(response_row['rid'])
+        if r_row is None:
+          failures.append((p_id, instance_id, row_id, "its rid %s isn't in the R table" % response_row['rid']))
+          continue
+        perm, choice, result = response_row['d4'], cast_ballot_row['d3'], r_row['r']
+
+      # a row of the wrong length can't be stacked with the others
+      if len(perm) != perm_plan.width or len(choice) != choices_plan.width or len(result) != choices_plan.width:
+        failures.append((p_id, instance_id, row_id, "its %s permutation or choices have the wrong length" % side.lower()))
+        continue
+
+      row_ids.append(row_id)
+      perms.append(perm)
+      choices.append(choice)
+      results.append(result)
+
+    # the permutations of the whole group at once
+    for position in batch.check_gathers(batch.stack(perms), batch.stack(choices), batch.stack(results), perm_plan.leaves, choices_plan.leaves):
+      failures.append((p_id, instance_id, row_ids[position], "the %s permutation doesn't match" % side.lower()))
+
+  assert not failures, d_row_failures_report(sorted(failures))
+
+  output_stream.write("""Election ID: %s
+Meeting 4 Successful
+
+Challenges Match Randomness? %s
+
+%s
+""" % (election.spec.id, challenges_match_randomness, base.fingerprint_report(fingerprints)))
+
+##
+## the files of a data directory, loaded as they are needed
+##
+
+# the label of each file in the fingerprint reports, by the name of its constant in filenames
+LABELS = {
+  'PARTITIONS': 'Partition File',
+  'ELECTION_SPEC': 'Election Spec',
+  'MEETING_ONE_IN': 'Meeting One In',
+  'MEETING_ONE_OUT': 'Meeting One Out',
+  'MEETING_TWO_IN': 'Meeting Two In',
+  'MEETING_TWO_OUT': 'Meeting Two Out',
+  'MEETING_TWO_OUT_COMMITMENTS': 'Meeting Two Out Commitments',
+  'MEETING_TWO_RANDOM_DATA': 'Random Data for Meeting Two Challenges',
+  'MEETING_THREE_IN': 'Meeting Three In',
+  'MEETING_THREE_OUT': 'Meeting Three Out',
+  'MEETING_THREE_OUT_CODES': 'Meeting Three Out Codes',
+  'CONTESTED_BALLOTS_REPLY': 'Reply to Contested Ballots',
+  'SPOILED_BALLOTS_CODES': 'Spoiled Ballots Codes',
+  'SPOILED_BALLOTS_MIXNET': 'Spoiled Ballots Mixnet',
+  'UNUSED_BALLOTS_CODES': 'Unused Ballots Codes',
+  'UNUSED_BALLOTS_MIXNET': 'Unused Ballots Mixnet',
+  'MEETING_FOUR_IN': 'Meeting Four In',
+  'MEETING_FOUR_OUT': 'Meeting Four Out',
+  'MEETING_FOUR_RANDOM_DATA': 'Random Data for Meeting Four Challenges',
+  }
+
+# the files whose fingerprints each stage reports, in the order its script always has
+ELECTION_FILES = ['PARTITIONS', 'ELECTION_SPEC', 'MEETING_ONE_IN']
+MEETING_ONE_FILES = ELECTION_FILES + ['MEETING_ONE_OUT']
+MEETING_TWO_FILES = MEETING_ONE_FILES + ['MEETING_TWO_IN', 'MEETING_TWO_OUT', 'MEETING_TWO_OUT_COMMITMENTS', 'MEETING_TWO_RANDOM_DATA']
+MEETING_THREE_FILES = MEETING_TWO_FILES + ['MEETING_THREE_IN', 'MEETING_THREE_OUT', 'MEETING_THREE_OUT_CODES']
+CONTESTED_BALLOTS_FILES = MEETING_THREE_FILES + ['CONTESTED_BALLOTS_REPLY']
+SPOILED_BALLOTS_FILES = MEETING_THREE_FILES + ['SPOILED_BALLOTS_CODES', 'SPOILED_BALLOTS_MIXNET']
+UNUSED_BALLOTS_FILES = MEETING_THREE_FILES + ['UNUSED_BALLOTS_CODES', 'UNUSED_BALLOTS_MIXNET']
+MEETING_FOUR_FILES = MEETING_THREE_FILES + ['MEETING_FOUR_IN', 'MEETING_FOUR_OUT', 'MEETING_FOUR_RANDOM_DATA']
+
+class LoadedFiles(object):
+  """
+  what was loaded from the files of one data directory, and their fingerprints,
+  shared by the contexts of that directory
+  """
+  def __init__(self):
+    # what was loaded, by the tuple of files it came from
+    self.results = {}
+
+    # the fingerprint entries by file, and the files in the order they were fingerprinted
+    self.fingerprints = {}
+    self.order = []
+
+  def add_fingerprint(self, file, fingerprint):
+    if not self.fingerprints.has_key(file):
+      self.order.append(file)
+    self.fingerprints[file] = fingerprint
+
+class AuditContext(object):
+  """
+  The data of one data directory, each file loaded the first time something needs it,
+  and then kept. With provisional, the meeting 3 files are those with the provisional
+  ballots added.
+
+  Each file is fingerprinted as it is loaded. A stage reports the fingerprints of all
+  the files its script has always reported, and those it didn't need to load are
+  only fingerprinted, not parsed.
+
+  Contexts don't share anything, unless one is made from the other with with_provisional.
+
+  The stages spread their checks over workers processes, base.WORKERS (--workers N) by default.
+  """
+
+  def __init__(self, data_path, provisional=False, loaded=None, workers=None):
+    self.data_path = data_path
+    self.provisional = provisional
+    self.workers = workers
+
+    if loaded is None:
+      loaded = LoadedFiles()
+    self.__loaded = loaded
+
+  def with_provisional(self, provisional=True):
+    """
+    the context of the same data directory, with or without the provisional ballots,
+    sharing the files already loaded
+    """
+    return AuditContext(self.data_path, provisional, self.__loaded, self.workers)
+
+  ##
+  ## the files
+  ##
+
+  def file(self, name):
+    """
+    the file name and fingerprint label of a file, by the name of its constant in filenames
+    """
+    meeting_three = ['MEETING_THREE_IN', 'MEETING_THREE_OUT', 'MEETING_THREE_OUT_CODES']
+    if name in meeting_three:
+      file = filenames.meeting_three_files(self.provisional)[meeting_three.index(name)]
+    else:
+      file = getattr(filenames, name)
+    return file, LABELS[name]
+
+  def has(self, names):
+    """
+    are the files all there
+    """
+    return all([os.path.exists(os.path.join(self.data_path, self.file(name)[0])) for name in names])
+
+  def has_provisional(self):
+    return self.with_provisional().has(['MEETING_THREE_IN', 'MEETING_THREE_OUT', 'MEETING_THREE_OUT_CODES'])
+
+  def fingerprints(self, names):
+    """
+    the fingerprints of the files, computed now for those that aren't loaded
+    """
+    result = []
+    for name in names:
+      file, label = self.file(name)
+      if not self.__loaded.fingerprints.has_key(file):
+        self.__loaded.add_fingerprint(file, [label, base.fingerprint_file(self.data_path, file)])
+      result.append(self.__loaded.fingerprints[file])
+    return result
+
+  def all_fingerprints(self):
+    """
+    the fingerprints of all the files used so far, in the order they were first used
+    """
+    return [self.__loaded.fingerprints[file] for file in self.__loaded.order]
+
+  def __load(self, names, load):
+    """
+    what load() makes of the files, loading them the first time only
+    """
+    files = [self.file(name) for name in names]
+    key = tuple([file for file, label in files])
+
+    if not self.__loaded.results.has_key(key):
+      first_fingerprint = len(base.FINGERPRINTS)
+      self.__loaded.results[key] = load()
+      for (file, label), fingerprint in zip(files, base.FINGERPRINTS[first_fingerprint:]):
+        self.__loaded.add_fingerprint(file, fingerprint)
+
+    return self.__loaded.results[key]
+
+  def __tables(self, name):
+    file, label = self.file(name)
+    return self.__load([name], lambda: data.load_tables(self.data_path, file, label))
+
+  def __random_data(self, name):
+    file, label = self.file(name)
+    return self.__load([name], lambda: base.file_in_dir(self.data_path, file, label, xml=False, correct_windows=False))
+
+  ##
+  ## election parameters
+  ##
+
+  def __election_params(self):
+    return self.__load(ELECTION_FILES, lambda: data.load_election_params(self.data_path))
+
+  @property
+  def partition_info(self):
+    return self.__election_params()[0]
+
+  @property
+  def election_spec(self):
+    return self.__election_params()[1]
+
+  @property
+  def election(self):
+    return self.__election_params()[2]
+
+  ##
+  ## meeting 1, the committed P and D tables
+  ##
+
+  @property
+  def p_table(self):
+    return self.__tables('MEETING_ONE_OUT').p_table()
+
+  @property
+  def partitions(self):
+    return self.__tables('MEETING_ONE_OUT').d_tables()
+
+  ##
+  ## meeting 2, the challenges, their responses, and the ballot code commitments
+  ##
+
+  @property
+  def challenge_p_table(self):
+    return self.__tables('MEETING_TWO_IN').p_table('challenges/print')
+
+  @property
+  def challenge_row_ids(self):
+    return self.challenge_p_table.rows.keys()
+
+  @property
+  def response_p_table(self):
+    return self.__tables('MEETING_TWO_OUT').p_table()
+
+  @property
+  def response_partitions(self):
+    return self.__tables('MEETING_TWO_OUT').d_tables()
+
+  @property
+  def ballots(self):
+    return self.__tables('MEETING_TWO_OUT_COMMITMENTS').ballot_table()
+
+  @property
+  def meeting_two_random_data(self):
+    return self.__random_data('MEETING_TWO_RANDOM_DATA')
+
+  ##
+  ## meeting 3, the votes, with or without the provisional ballots
+  ##
+
+  @property
+  def p_table_votes(self):
+    return self.__tables('MEETING_THREE_IN').p_table('print')
+
+  @property
+  def cast_ballot_partitions(self):
+    return self.__tables('MEETING_THREE_OUT').d_tables()
+
+  @property
+  def r_tables(self):
+    return self.__tables('MEETING_THREE_OUT').r_tables()
+
+  def r_rows(self):
+    """
+    the (partition ID, attributes) of each row of the R tables, read off the file as they
+    are needed and not kept (see data.stream_r_rows). The file is fingerprinted as it is read,
+    as when it is loaded.
+    """
+    file, label = self.file('MEETING_THREE_OUT')
+    first_fingerprint = len(base.FINGERPRINTS)
+    for row in data.stream_r_rows(base.iterparse_file_in_dir(self.data_path, file, label)):
+      yield row
+    self.__loaded.add_fingerprint(file, base.FINGERPRINTS[first_fingerprint])
+
+  @property
+  def ballots_with_codes(self):
+    return self.__tables('MEETING_THREE_OUT_CODES').ballot_table()
+
+  ##
+  ## contested, spoiled and unused ballots
+  ##
+
+  @property
+  def contested_ballots(self):
+    return self.__tables('CONTESTED_BALLOTS_REPLY').ballot_table()
+
+  @property
+  def spoiled_ballots(self):
+    return self.__tables('SPOILED_BALLOTS_CODES').ballot_table()
+
+  @property
+  def spoiled_p_table(self):
+    return self.__tables('SPOILED_BALLOTS_MIXNET').p_table()
+
+  @property
+  def spoiled_partitions(self):
+    return self.__tables('SPOILED_BALLOTS_MIXNET').d_tables()
+
+  @property
+  def unused_ballots(self):
+    return self.__tables('UNUSED_BALLOTS_CODES').ballot_table()
+
+  @property
+  def unused_p_table(self):
+    return self.__tables('UNUSED_BALLOTS_MIXNET').p_table()
+
+  @property
+  def unused_partitions(self):
+    return self.__tables('UNUSED_BALLOTS_MIXNET').d_tables()
+
+  ##
+  ## meeting 4, the challenges of the D tables of votes and their responses
+  ##
+
+  @property
+  def d_table_challenges(self):
+    return self.__tables('MEETING_FOUR_IN').d_tables()
+
+  @property
+  def d_table_responses(self):
+    return self.__tables('MEETING_FOUR_OUT').d_tables()
+
+  @property
+  def meeting_four_random_data(self):
+    return self.__random_data('MEETING_FOUR_RANDOM_DATA')
+
+##
+## the stages, each run on a context
+##
+
+def meeting_one(context, output_stream, codes_output_stream=None):
+  verify_meeting_one(output_stream, context.fingerprints(MEETING_ONE_FILES), context.election,
+                     context.p_table, context.partitions)
+
+def meeting_two(context, output_stream, codes_output_stream=None):
+  verify_meeting_two(output_stream, context.fingerprints(MEETING_TWO_FILES), context.election,
+                     context.p_table, context.partitions, context.challenge_p_table,
+                     context.response_p_table, context.response_partitions, context.meeting_two_random_data, context.workers)
+
+def meeting_three(context, output_stream, codes_output_stream=None, codes_index_path=None):
+  verify_meeting_three(output_stream, context.fingerprints(MEETING_THREE_FILES), context.election,
+                       context.challenge_row_ids, context.ballots, context.p_table_votes, context.ballots_with_codes,
+                       codes_output_stream, codes_index_path, context.workers)
+
+def meeting_three_provisional(context, output_stream, codes_output_stream=None, codes_index_path=None, delta=None):
+  """
+  meeting 3 on a context with the provisional ballots. With delta (base.DELTA, --delta, by default),
+  only the ballots that aren't in the regular meeting 3 files are checked, see verify_meeting_three_delta
+  """
+  if delta is None:
+    delta = base.DELTA
+  if not delta:
+    return meeting_three(context, output_stream, codes_output_stream, codes_index_path)
+
+  regular = context.with_provisional(False)
+  verify_meeting_three_delta(output_stream, context.fingerprints(MEETING_THREE_FILES),
+                             regular.fingerprints(['MEETING_THREE_IN', 'MEETING_THREE_OUT_CODES']), context.election,
+                             context.challenge_row_ids, context.ballots, regular.p_table_votes, regular.ballots_with_codes,
+                             context.p_table_votes, context.ballots_with_codes, codes_output_stream, codes_index_path, context.workers)
+
+def contested_ballots(context, output_stream, codes_output_stream=None, codes_index_path=None):
+  verify_contested_ballots(output_stream, context.fingerprints(CONTESTED_BALLOTS_FILES), context.election,
+                           context.ballots, context.ballots_with_codes, context.contested_ballots,
+                           codes_output_stream, codes_index_path, context.workers)
+
+def spoiled_ballots(context, output_stream, codes_output_stream=None, codes_index_path=None):
+  verify_spoiled_ballots(output_stream, context.fingerprints(SPOILED_BALLOTS_FILES), context.election,
+                         context.p_table, context.partitions, context.ballots,
+                         context.spoiled_ballots, context.spoiled_p_table, context.spoiled_partitions,
+                         codes_output_stream, codes_index_path, context.workers)
+
+def unused_ballots(context, output_stream, codes_output_stream=None):
+  verify_unused_ballots(output_stream, context.fingerprints(UNUSED_BALLOTS_FILES), context.election,
+                        context.p_table, context.partitions, context.ballots,
+                        context.unused_ballots, context.unused_p_table, context.unused_partitions, codes_output_stream, context.workers)
+
+def meeting_four(context, output_stream, codes_output_stream=None):
+  verify_meeting_four(output_stream, context.fingerprints(MEETING_FOUR_FILES), context.election,
+                      context.partitions, context.response_partitions, context.p_table_votes,
+                      context.cast_ballot_partitions, context.r_tables, context.d_table_challenges, context.d_table_responses,
+                      context.meeting_four_random_data, context.workers)
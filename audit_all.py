@@ -0,0 +1,108 @@
+"""
+The whole audit of one data directory, in one process
+
+Usage:
+python audit_all.py <DATA_PATH> [<CODES_DIR>] [--workers N] [--delta]
+
+data path should NOT have a trailing slash
+
+Each file is loaded once (see audit.AuditContext), then all the stages run in order,
+each writing the report its own script writes: meeting1.py, meeting2.py, meeting3.py,
+meeting3provisional.py, contested-ballots.py, spoiled-ballot-verification.py,
+unused-ballots.py and meeting4.py. A stage whose files are missing is skipped,
+and a stage that fails, on a check or on any other error, is reported with its
+traceback and doesn't stop the ones after it.
+
+With --delta, meeting3provisional.py only checks the ballots that aren't in the regular
+meeting 3 files, as the script does with --delta, if meeting3.py succeeded just before.
+
+CODES_DIR, when provided, is the directory where the confirmation codes are written,
+one file for each stage that writes them, named after its script, e.g. meeting3.csv
+"""
+
+import sys, os, traceback
+import base, audit
+
+# the stages in order: the script whose report they write, whether they write codes,
+# which meeting 3 files they use, the files they need, and the stage itself.
+# The meeting 3 files are the regular ones, those with provisional ballots,
+# or those with provisional ballots if there are some.
+STAGES = [
+  ('meeting1.py', False, 'regular', audit.MEETING_ONE_FILES, audit.meeting_one),
+  ('meeting2.py', False, 'regular', audit.MEETING_TWO_FILES, audit.meeting_two),
+  ('meeting3.py', True, 'regular', audit.MEETING_THREE_FILES, audit.meeting_three),
+  ('meeting3provisional.py', True, 'provisional', audit.MEETING_THREE_FILES, audit.meeting_three_provisional),
+  ('contested-ballots.py', True, 'any provisional', audit.CONTESTED_BALLOTS_FILES, audit.contested_ballots),
+  ('spoiled-ballot-verification.py', True, 'regular', audit.SPOILED_BALLOTS_FILES, audit.spoiled_ballots),
+  ('unused-ballots.py', True, 'regular', audit.UNUSED_BALLOTS_FILES, audit.unused_ballots),
+  ('meeting4.py', False, 'any provisional', audit.MEETING_FOUR_FILES, audit.meeting_four),
+  ]
+
+# the stages that check only what an earlier one didn't with --delta, and that earlier stage
+DELTA_STAGES = {'meeting3provisional.py': 'meeting3.py'}
+
+def run(context, output_stream, codes_dir=None):
+  """
+  run all the stages on the data directory of the context, writing their reports
+  one after the other. The files are loaded once for all the stages.
+  Returns the list of (script, result) pairs, the result being
+  'SUCCESSFUL', 'FAILED' or 'SKIPPED'
+  """
+  contexts = {
+    'regular': context.with_provisional(False),
+    'provisional': context.with_provisional(True),
+    'any provisional': context.with_provisional(context.has_provisional()),
+    }
+
+  results = []
+
+  for script, writes_codes, variant, files, stage in STAGES:
+    output_stream.write("==== %s ====\n" % script)
+
+    stage_context = contexts[variant]
+    if not stage_context.has(files):
+      output_stream.write("Skipped, its files are not in %s\n\n" % context.data_path)
+      results.append((script, 'SKIPPED'))
+      continue
+
+    codes_output = None
+    if codes_dir and writes_codes:
+      codes_output = open(os.path.join(codes_dir, os.path.splitext(script)[0] + '.csv'), "w")
+
+    # with --delta, a stage only checks what another one didn't if that one succeeded
+    options = {}
+    if DELTA_STAGES.has_key(script):
+      options['delta'] = base.DELTA and (DELTA_STAGES[script], 'SUCCESSFUL') in results
+
+    try:
+      stage(stage_context, output_stream, codes_output, **options)
+    except Exception:
+      # whatever went wrong, it's this stage that failed, the others still run
+      output_stream.write(traceback.format_exc() + "\n")
+      results.append((script, 'FAILED'))
+    else:
+      results.append((script, 'SUCCESSFUL'))
+    finally:
+      if codes_output:
+        codes_output.close()
+
+  return results
+
+def summary(results):
+  report = ""
+  for script, result in results:
+    report += "%s: %s\n" % (script, result)
+  return report
+
+if __name__ == '__main__':
+  if len(sys.argv) > 2:
+    codes_dir = sys.argv[2]
+  else:
+    codes_dir = None
+
+  results = run(audit.AuditContext(base.DATA_PATH), sys.stdout, codes_dir)
+
+  sys.stdout.write("==== Summary ====\n%s" % summary(results))
+
+  if 'FAILED' in [result for script, result in results]:
+    sys.exit(1)
@@ -0,0 +1,85 @@
+"""
+The whole audit of several data directories, e.g. the wards of a city, side by side
+
+Usage:
+python audit_wards.py <DATA_PATH_1> <DATA_PATH_2> ... [--workers N]
+
+data paths should NOT have a trailing slash
+
+Each data directory is audited as audit_all.py does it, in its own worker process
+with --workers N. The largest directories are started first, so the whole run
+takes about as long as the largest one when there are enough workers.
+
+The reports of all the directories follow, in the order given, then a summary
+of every stage of every directory, and the fingerprints of all their files.
+"""
+
+import sys, os, traceback, StringIO
+import base, audit, audit_all
+
+def data_size(data_path):
+  """
+  the total size of the files in a data directory, to tell how long its audit takes
+  """
+  return sum([os.path.getsize(os.path.join(data_path, file)) for file in os.listdir(data_path)
+              if os.path.isfile(os.path.join(data_path, file))])
+
+def audit_ward(data_path):
+  """
+  the full audit of one data directory, as audit_all.py does it.
+  Returns the reports, the results of the stages, and the fingerprints of all the files.
+
+  Anything that goes wrong outside of the stages, which audit_all.run already reports,
+  is this directory's failure, reported with its traceback, and the others go on.
+  """
+  # the wards are what is spread over the processes, not the checks within a ward
+  context = audit.AuditContext(data_path, workers=1)
+
+  # what the checks print goes in the report too
+  output = StringIO.StringIO()
+  stdout, sys.stdout = sys.stdout, output
+  try:
+    results = audit_all.run(context, output)
+  except Exception:
+    output.write(traceback.format_exc() + "\n")
+    results = [('audit_all.py', 'FAILED')]
+  finally:
+    sys.stdout = stdout
+
+  return output.getvalue(), results, context.all_fingerprints()
+
+def audit_wards(data_paths, workers=None):
+  """
+  audit the data directories over workers processes (base.WORKERS by default),
+  the largest first. The results come back in the order of data_paths.
+  """
+  order = sorted(range(len(data_paths)), key=lambda i: data_size(data_paths[i]), reverse=True)
+  results = base.parallel_map(audit_ward, [data_paths[i] for i in order], workers, chunksize=1)
+  
+  ward_results = [None] * len(data_paths)
+  for i, result in zip(order, results):
+    ward_results[i] = result
+  return ward_results
+
+def summary(data_paths, ward_results):
+  report = ""
+  for data_path, (output, results, fingerprints) in zip(data_paths, ward_results):
+    report += "%s\n%s\n" % (data_path, audit_all.summary(results))
+
+  for data_path, (output, results, fingerprints) in zip(data_paths, ward_results):
+    report += "Fingerprints of %s\n%s\n" % (data_path, base.fingerprint_report(fingerprints))
+
+  return report
+
+if __name__ == '__main__':
+  data_paths = sys.argv[1:]
+  ward_results = audit_wards(data_paths)
+
+  for data_path, (output, results, fingerprints) in zip(data_paths, ward_results):
+    sys.stdout.write("######## %s ########\n%s" % (data_path, output))
+
+  sys.stdout.write("######## Summary ########\n%s" % summary(data_paths, ward_results))
+
+  for output, results, fingerprints in ward_results:
+    if 'FAILED' in [result for script, result in results]:
+      sys.exit(1)
@@ -6,9 +6,55 @@ not called directly
 data path should NOT have a trailing slash
 """
 
-import sys, hashlib
+import sys, os, hashlib, itertools, multiprocessing, cPickle
 from xml.etree import ElementTree
 
+def _pop_option(name, default, convert=str):
+  """
+  take an option and its value off the command line, wherever it is,
+  so that the positional arguments keep their place
+  """
+  if name not in sys.argv:
+    return default
+  index = sys.argv.index(name)
+  value = convert(sys.argv[index + 1])
+  del sys.argv[index:index + 2]
+  return value
+
+# the number of worker processes for the checks that can be spread out,
+# given as --workers N anywhere on the command line
+WORKERS = _pop_option('--workers', 1, int)
+
+def _pop_flag(name):
+  """
+  take a flag off the command line, wherever it is. True if it was there
+  """
+  if name not in sys.argv:
+    return False
+  sys.argv.remove(name)
+  return True
+
+# store table rows by column rather than as dictionaries, for less memory,
+# given as --compact-tables anywhere on the command line
+COMPACT_TABLES = _pop_flag('--compact-tables')
+
+# how many rows of split permutations each table keeps, most recently used first,
+# given as --permutation-cache N anywhere on the command line
+PERMUTATION_CACHE_SIZE = _pop_option('--permutation-cache', 10000, int)
+
+# a directory where parsed files are kept from one run to the next,
+# given as --cache-dir DIR anywhere on the command line. No caching without it.
+CACHE_DIR = _pop_option('--cache-dir', None)
+
+# meeting3provisional.py only checks the ballots that aren't in the regular meeting 3 files,
+# and that the others are the same there, given as --delta anywhere on the command line
+DELTA = _pop_flag('--delta')
+
+# a file where meeting3.py, meeting3provisional.py, contested-ballots.py and spoiled-ballot-verification.py
+# also write their codes as an index by web serial number (see codes.py),
+# given as --codes-index FILE anywhere on the command line
+CODES_INDEX = _pop_option('--codes-index', None)
+
 if len(sys.argv) > 1:
   DATA_PATH = sys.argv[1]
 else:
@@ -19,9 +65,15 @@ FINGERPRINTS = []
 def add_fingerprint(filename, hash_value):
   FINGERPRINTS.append([filename, hash_value])
 
-def fingerprint_report():
+def fingerprint_report(fingerprints=None):
+  """
+  the report of the fingerprints given, by default of all the files loaded so far
+  """
+  if fingerprints is None:
+    fingerprints = FINGERPRINTS
+  
   report = ""
-  for filename, fingerprint in FINGERPRINTS:
+  for filename, fingerprint in fingerprints:
     report += filename + ": " + fingerprint + "\n"
   return report
 
@@ -29,34 +81,259 @@ def fingerprint_report():
 ## loading files and adding fingerprints
 ##
 
-def file_in_dir(dir, file, filename, xml = True, correct_windows= False):
+# how much of a file is read at a time
+READ_SIZE = 64 * 1024
+
+def _open_in_dir(dir, file):
   path = dir + "/" + file
 
   try:
-    f = open(path, "r")
+    return open(path, "r")
   except:
     print "could not find file %s" % path
     sys.exit(1)
-  contents = f.read()
-  f.close()
+
+class FingerprintingReader(object):
+  """
+  a file wrapper that computes the fingerprint of the file while it is read in chunks.
   
-  # must do windows style verification loading of newlines
-  if correct_windows and contents.find('\r') == -1:
-    print "fixing windows"
-    contents = contents.replace('\n','\r\n')    
+  With correct_windows, the fingerprint is that of the file with windows-style newlines,
+  unless the file already has some. We can't know that until the end, so both hashes
+  are kept until a '\r' shows up.
+  """
+  def __init__(self, f, correct_windows=False):
+    self.f = f
+    self.sha = hashlib.sha1()
+    self.windows_sha = None
+    if correct_windows:
+      self.windows_sha = hashlib.sha1()
+    self.seen_cr = False
+  
+  def read(self, size=READ_SIZE):
+    chunk = self.f.read(size)
+    self.sha.update(chunk)
+    if self.windows_sha and not self.seen_cr:
+      if chunk.find('\r') == -1:
+        self.windows_sha.update(chunk.replace('\n','\r\n'))
+      else:
+        self.seen_cr = True
+    return chunk
+  
+  def close(self):
+    self.f.close()
+  
+  @property
+  def fixing_windows(self):
+    return self.windows_sha is not None and not self.seen_cr
   
-  add_fingerprint(filename, hashlib.sha1(contents).hexdigest())
+  def hexdigest(self):
+    if self.fixing_windows:
+      return self.windows_sha.hexdigest()
+    return self.sha.hexdigest()
+
+def file_in_dir(dir, file, filename, xml = True, correct_windows= False):
+  reader = FingerprintingReader(_open_in_dir(dir, file), correct_windows)
+  
+  # hash and parse in the same pass over the file
   if xml:
-    return ElementTree.fromstring(contents)
+    parser = ElementTree.XMLParser()
+    chunk = reader.read()
+    while chunk:
+      parser.feed(chunk)
+      chunk = reader.read()
+    result = parser.close()
   else:
-    return contents
+    result = ''.join(iter(reader.read, ''))
+  reader.close()
+  
+  # must do windows style verification loading of newlines
+  if reader.fixing_windows:
+    print "fixing windows"
+    if not xml:
+      result = result.replace('\n','\r\n')
+  
+  add_fingerprint(filename, reader.hexdigest())
+  return result
+
+# the fingerprint of a streamed file that wasn't read to the end
+INCOMPLETE_FINGERPRINT = "incomplete, the file wasn't read to the end"
+
+def iterparse_file_in_dir(dir, file, filename):
+  """
+  stream an XML file: generate the ('start', 'end') ElementTree.iterparse events
+  as the file is read in chunks and fingerprinted along the way. The whole tree
+  is never built unless the consumer keeps the elements around.
+  
+  The fingerprint takes its place in the report when the iteration starts,
+  and its value is filled in once the whole file has gone through. Until then,
+  and for good if the iteration stops early or the file can't be parsed,
+  it says so instead.
+  """
+  fingerprint = [filename, INCOMPLETE_FINGERPRINT]
+  FINGERPRINTS.append(fingerprint)
+  
+  reader = FingerprintingReader(_open_in_dir(dir, file))
+  try:
+    for event, element in ElementTree.iterparse(reader, events=('start', 'end')):
+      yield event, element
+    fingerprint[1] = reader.hexdigest()
+  finally:
+    reader.close()
+
+##
+## a cache of parsed files, keyed by their fingerprints
+##
+## An entry is only used if the fingerprints of the files, computed afresh on every run,
+## are the ones it was stored under, so a changed file is always parsed again.
+## The entries are pickles: the cache directory must be trusted as much as this code.
+##
+
+# goes up whenever the parsed structures change, so that older entries are left alone
+CACHE_VERSION = 4
+
+def fingerprint_file(dir, file):
+  """
+  the fingerprint of a file, as file_in_dir computes it for XML files
+  """
+  reader = FingerprintingReader(_open_in_dir(dir, file))
+  while reader.read():
+    pass
+  reader.close()
+  return reader.hexdigest()
+
+def _cache_path(kind, fingerprints):
+  key = hashlib.sha1(' '.join(fingerprints)).hexdigest()
+  return os.path.join(CACHE_DIR, '%s-%d-%s.pickle' % (kind, CACHE_VERSION, key))
+
+def load_in_dir(dir, files, parse, kind):
+  """
+  load what parse() makes of the XML files, a list of (file, filename) pairs.
+  parse() loads them the usual way, which adds their fingerprints to the report.
+  
+  With a cache directory, the result is stored under the fingerprints of the files
+  and the kind of result, and on a later run taken from there instead, with the
+  same fingerprints added to the report.
+  """
+  if not CACHE_DIR:
+    return parse()
+  
+  fingerprints = [fingerprint_file(dir, file) for file, filename in files]
+  path = _cache_path(kind, fingerprints)
+  
+  if os.path.exists(path):
+    try:
+      f = open(path, 'rb')
+      try:
+        result = cPickle.load(f)
+      finally:
+        f.close()
+    except Exception:
+      # a damaged entry, parse again and replace it
+      pass
+    else:
+      for (file, filename), fingerprint in zip(files, fingerprints):
+        add_fingerprint(filename, fingerprint)
+      return result
+  
+  first_fingerprint = len(FINGERPRINTS)
+  result = parse()
+  
+  # the files might have changed since they were fingerprinted above,
+  # in which case the result is kept under what was actually parsed
+  parsed_fingerprints = [fingerprint for filename, fingerprint in FINGERPRINTS[first_fingerprint:]]
+  path = _cache_path(kind, parsed_fingerprints)
+  
+  if not os.path.isdir(CACHE_DIR):
+    os.makedirs(CACHE_DIR)
+  
+  # written under a temporary name, so a concurrent run never sees half an entry
+  temp_path = '%s.%d.tmp' % (path, os.getpid())
+  f = open(temp_path, 'wb')
+  try:
+    cPickle.dump(result, f, cPickle.HIGHEST_PROTOCOL)
+  finally:
+    f.close()
+  os.rename(temp_path, path)
+  
+  return result
     
+##
+## spreading work over processes
+##
+
+# how many rows go in one unit of work sent to a worker process
+CHUNK_SIZE = 500
+
+def chunks(lst, size=CHUNK_SIZE):
+  """
+  cut a list into consecutive pieces of at most size elements
+  """
+  return [lst[i:i + size] for i in range(0, len(lst), size)]
+
+def parallel_map(func, args_list, workers=None, chunksize=None):
+  """
+  apply func to each element of args_list, over a pool of worker processes
+  if more than one worker is asked for. The results come back in the order
+  of args_list, so merging them is deterministic and matches a serial run.
+  func must be a module-level function, so that it can be sent to the workers.
+  
+  With a chunksize of 1, the elements are handed out one at a time in order,
+  so the first ones in the list are started first.
+  """
+  if workers is None:
+    workers = WORKERS
+
+  if workers <= 1 or len(args_list) <= 1:
+    return map(func, args_list)
+
+  pool = multiprocessing.Pool(min(workers, len(args_list)))
+  try:
+    return pool.map(func, args_list, chunksize)
+  finally:
+    pool.close()
+    pool.join()
+
+def parallel_imap(func, args_list, workers=None):
+  """
+  parallel_map, one result at a time as they come in, still in the order of args_list,
+  so that the caller can deal with the first results while the workers go on with the others
+  """
+  if workers is None:
+    workers = WORKERS
+
+  if workers <= 1 or len(args_list) <= 1:
+    for args in args_list:
+      yield func(args)
+    return
+
+  pool = multiprocessing.Pool(min(workers, len(args_list)))
+  try:
+    for result in pool.imap(func, args_list):
+      yield result
+  finally:
+    pool.close()
+    pool.join()
+
 ##
 ## Pseudorandom Number Generation
 ##
 # reverse-engineered from
 # https://scantegrity.org/svn/data/takoma-nov3-2009/PUBLIC/PUBLIC/pre_election_audit.py
 
+
+class PRNG(object):
+  """
+  The same numbers as prng below, for one seed. The seed can be long (a whole random
+  data file), so it is hashed only once, and each index is hashed onto a copy of that.
+  """
+  
+  def __init__(self, seed):
+    self.__seed_hash = hashlib.sha1("%s" % seed)
+  
+  def __call__(self, index, modulus):
+    hash_state = self.__seed_hash.copy()
+    hash_state.update("%d" % index)
+    return int(hash_state.hexdigest(), 16) % modulus
     
 def prng(seed,index,modulus):
   """
@@ -71,20 +348,32 @@ def prng(seed,index,modulus):
   
   # modulo the modulus
   return hash_int % modulus
-  
-def generate_random_int_list(seed, modulus, num_ints):
+
+def prng_many(seed, indexes, modulus):
   """
-  generate a random list of num_ints integers modulo modulus, with the given seed.
+  prng(seed, index, modulus) for each of the indexes, hashing the seed only once
+  """
+  generator = PRNG(seed)
+  return [generator(index, modulus) for index in indexes]
+
+def random_ints(seed, modulus):
   """
-  output_list = []
+  generate distinct random integers modulo the modulus, with the given seed,
+  as many as are asked for, up to all of them
+  """
+  generator = PRNG(seed)
+  seen = set()
   counter = 0
-  while True:
-    new_index = prng(seed, counter, modulus)
+  while len(seen) < modulus:
+    new_index = generator(counter, modulus)
     counter += 1
-    if new_index in output_list:
+    if new_index in seen:
       continue
-    output_list.append(new_index)
-    if len(output_list) == num_ints:
-      break
-      
-  return output_list
+    seen.add(new_index)
+    yield new_index
+  
+def generate_random_int_list(seed, modulus, num_ints):
+  """
+  generate a random list of num_ints integers modulo modulus, with the given seed.
+  """
+  return list(itertools.islice(random_ints(seed, modulus), num_ints))
@@ -0,0 +1,291 @@
+"""
+Batched checks over many table rows at once
+
+The rows of a table are stacked into 2-D integer arrays, one row per table row,
+and a check runs over all of them in one go. NumPy does the work when it is
+installed; otherwise the same checks run as plain Python loops, with the same results.
+
+Failing rows are reported by their position in the stack, which the caller
+maps back to row IDs.
+"""
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+def stack(rows):
+  """
+  stack a list of equal-length lists of integers into a 2-D array
+  """
+  if numpy:
+    return numpy.array(rows, dtype=numpy.int32).reshape(len(rows), len(rows[0]) if rows else 0)
+  return [list(row) for row in rows]
+
+def stack_fields(fields):
+  """
+  stack permutation fields, each the text of integers separated by spaces as in the XML
+  or already a list, into a 2-D array, reading all the text at once.
+  Raises ValueError if they are not all of the same length.
+  """
+  texts = []
+  for field in fields:
+    if type(field) == list:
+      field = " ".join(["%d" % value for value in field])
+    texts.append(field)
+
+  widths = set([text.count(' ') + 1 for text in texts])
+  if len(widths) > 1:
+    raise ValueError("the fields are of lengths %s" % sorted(widths))
+  if not texts:
+    return stack([])
+  width = widths.pop()
+
+  if numpy:
+    values = numpy.fromstring(" ".join(texts), dtype=numpy.int32, sep=' ')
+    if values.size != len(texts) * width:
+      raise ValueError("some fields aren't integers separated by spaces")
+    return values.reshape(len(texts), width)
+  return [[int(value) for value in text.split(' ')] for text in texts]
+
+def to_lists(rows):
+  """
+  the rows of a 2-D array as lists of Python integers
+  """
+  if numpy and hasattr(rows, 'tolist'):
+    return rows.tolist()
+  return [list(row) for row in rows]
+
+def failing_positions(ok):
+  """
+  the positions where a vector of per-row results is False
+  """
+  return [i for i, row_ok in enumerate(ok) if not row_ok]
+
+##
+## permutations
+##
+## A permutation maps position i to perm[i]. A -1 is a non-position and is left alone,
+## as in data.Permutation. Each row holds the concatenation of several permutations,
+## one per question, given as (start, stop) segments of the row.
+##
+
+def _numpy_gather(values, indexes):
+  """
+  values[r][indexes[r][i]] for every r, i, with -1 staying -1.
+  Returns the result and the per-row flag of indexes in range.
+  """
+  width = values.shape[1]
+  in_range = ((indexes >= -1) & (indexes < width)).all(axis=1)
+  safe = numpy.where((indexes < 0) | (indexes >= width), 0, indexes)
+  result = values[numpy.arange(values.shape[0])[:, None], safe]
+  return numpy.where(indexes == -1, -1, result), in_range
+
+def _numpy_inverse(perms):
+  """
+  invert each row's permutation, with the per-row flag of those that are permutations
+  """
+  num_rows, width = perms.shape
+  valid = (numpy.sort(perms, axis=1) == numpy.arange(width)).all(axis=1)
+  safe = numpy.where(valid[:, None], perms, numpy.arange(width))
+  inverse = numpy.empty_like(perms)
+  inverse[numpy.arange(num_rows)[:, None], safe] = numpy.arange(width)
+  return inverse, valid
+
+def _python_gather(values, indexes):
+  if indexes == -1:
+    return -1
+  if indexes < -1 or indexes >= len(values):
+    raise IndexError
+  return values[indexes]
+
+def check_compositions(left, right, p_1, p_2, segments):
+  """
+  check, segment by segment, that left then right is the same as p_2 then the inverse of p_1,
+  which is what meeting2 checks of d2 and d4 against p1 and p2.
+
+  All four are stacked row by row, so that row r of left and right goes with
+  row r of p_1 and p_2. Returns the positions of the rows that don't match,
+  including those where p_1 isn't a permutation or an index is out of range.
+  """
+  num_rows = len(left)
+  if num_rows == 0:
+    return []
+
+  if numpy:
+    ok = numpy.ones(num_rows, dtype=bool)
+    for start, stop in segments:
+      composed, left_ok = _numpy_gather(right[:, start:stop], left[:, start:stop])
+      inverse, p_1_ok = _numpy_inverse(p_1[:, start:stop])
+      p_composed, p_2_ok = _numpy_gather(inverse, p_2[:, start:stop])
+      ok &= left_ok & p_1_ok & p_2_ok & (composed == p_composed).all(axis=1)
+    return failing_positions(ok)
+
+  failing = []
+  for r in range(num_rows):
+    for start, stop in segments:
+      p_1_segment = p_1[r][start:stop]
+      if sorted(p_1_segment) != range(stop - start):
+        failing.append(r)
+        break
+      inverse = [None] * (stop - start)
+      for i, value in enumerate(p_1_segment):
+        inverse[value] = i
+      try:
+        composed = [_python_gather(right[r][start:stop], i) for i in left[r][start:stop]]
+        p_composed = [_python_gather(inverse, i) for i in p_2[r][start:stop]]
+      except IndexError:
+        failing.append(r)
+        break
+      if composed != p_composed:
+        failing.append(r)
+        break
+  return failing
+
+def check_gathers(values, indexes, expected, value_segments, index_segments):
+  """
+  check, segment by segment, that values taken at indexes are the expected ones,
+  which is what meeting4 checks of either side of a D table row: d2 at p3 is d3,
+  and d4 at d3 is r.
+
+  The segments of values and of indexes go in pairs, one pair per permutation:
+  indexes and expected share theirs. Returns the positions of the rows that don't match,
+  including those where an index is out of range.
+  """
+  num_rows = len(values)
+  if num_rows == 0:
+    return []
+
+  if numpy:
+    ok = numpy.ones(num_rows, dtype=bool)
+    for (v_start, v_stop), (i_start, i_stop) in zip(value_segments, index_segments):
+      gathered, in_range = _numpy_gather(values[:, v_start:v_stop], indexes[:, i_start:i_stop])
+      ok &= in_range & (gathered == expected[:, i_start:i_stop]).all(axis=1)
+    return failing_positions(ok)
+
+  failing = []
+  for r in range(num_rows):
+    for (v_start, v_stop), (i_start, i_stop) in zip(value_segments, index_segments):
+      try:
+        gathered = [_python_gather(values[r][v_start:v_stop], i) for i in indexes[r][i_start:i_stop]]
+      except IndexError:
+        failing.append(r)
+        break
+      if gathered != list(expected[r][i_start:i_stop]):
+        failing.append(r)
+        break
+  return failing
+
+##
+## encodings
+##
+## The open symbols of a question on many ballots are given as one flat list,
+## with the number of symbols of each ballot, and the p3 entries of the question
+## as a stack with a row per ballot, each max_num_answers wide.
+##
+
+def _numpy_symbol_rows(symbols, counts):
+  """
+  the symbols as an array, with the row of each symbol and its position among the row's symbols
+  """
+  symbols = numpy.array(symbols, dtype=numpy.int64)
+  counts = numpy.array(counts, dtype=numpy.int64)
+  rows = numpy.repeat(numpy.arange(len(counts)), counts)
+  starts = numpy.cumsum(counts) - counts
+  return symbols, counts, rows, numpy.arange(len(symbols)) - starts[rows]
+
+def check_rank_encodings(p_3, symbols, counts, max_num_answers):
+  """
+  each symbol of a ranked question is rank * max_num_answers + position, so the p3 entries
+  of a row must be the rank at each position of its symbols, and -1 everywhere else.
+  Returns the positions of the rows that don't match.
+  """
+  num_rows = len(counts)
+  if num_rows == 0:
+    return []
+  mx = max_num_answers
+
+  if numpy:
+    symbols, counts, rows, indexes = _numpy_symbol_rows(symbols, counts)
+    cells = rows * mx + symbols % mx
+    expected = numpy.empty(num_rows * mx, dtype=numpy.int64)
+    expected.fill(-1)
+    expected[cells] = symbols // mx
+
+    # two symbols at the same position can't both match
+    same_position = (numpy.bincount(cells, minlength=num_rows * mx) > 1).reshape(num_rows, mx).any(axis=1)
+    ok = (p_3 == expected.reshape(num_rows, mx)).all(axis=1) & ~same_position
+    return failing_positions(ok)
+
+  failing = []
+  start = 0
+  for r in range(num_rows):
+    row_symbols = symbols[start:start + counts[r]]
+    start += counts[r]
+    if [p_3[r][symbol % mx] for symbol in row_symbols] != [symbol / mx for symbol in row_symbols] or \
+       len([p for p in p_3[r] if p != -1]) != len(row_symbols):
+      failing.append(r)
+  return failing
+
+def check_single_encodings(p_3, symbols, counts, max_num_answers):
+  """
+  the p3 entries of a row must be its symbols, in order, up to the first -1.
+  Returns the positions of the rows that don't match.
+  """
+  num_rows = len(counts)
+  if num_rows == 0:
+    return []
+  mx = max_num_answers
+
+  if numpy:
+    symbols, counts, rows, indexes = _numpy_symbol_rows(symbols, counts)
+    fits = indexes < mx
+    expected = numpy.empty(num_rows * mx, dtype=numpy.int64)
+    expected.fill(-1)
+    expected[rows[fits] * mx + indexes[fits]] = symbols[fits]
+
+    # the symbols, then the -1 that ends them if they don't fill the row
+    compared = numpy.arange(mx) <= counts[:, None]
+    ok = ((p_3 == expected.reshape(num_rows, mx)) | ~compared).all(axis=1) & (counts <= mx)
+    return failing_positions(ok)
+
+  failing = []
+  start = 0
+  for r in range(num_rows):
+    row_symbols = list(symbols[start:start + counts[r]])
+    start += counts[r]
+    row = list(p_3[r])
+    if -1 in row:
+      row = row[:row.index(-1)]
+    if row != row_symbols:
+      failing.append(r)
+  return failing
+
+##
+## tallies
+##
+
+def count_values(values):
+  """
+  the number of times each integer comes up in a 2-D array, as a dictionary
+  """
+  if numpy:
+    flat = numpy.asarray(values, dtype=numpy.int64).ravel()
+    if not flat.size:
+      return {}
+    lowest = flat.min()
+    if flat.max() - lowest > 2 * flat.size + 1024:
+      # too spread out to count in place
+      found, counts = numpy.unique(flat, return_counts=True)
+    else:
+      counts = numpy.bincount(flat - lowest)
+      found = numpy.flatnonzero(counts)
+      counts = counts[found]
+      found += lowest
+    return dict(zip(found.tolist(), counts.tolist()))
+
+  counts = {}
+  for row in values:
+    for value in row:
+      counts[value] = counts.get(value, 0) + 1
+  return counts
@@ -0,0 +1,224 @@
+"""
+The confirmation codes, as written out by meeting3 and the spoiled and unused ballots
+
+The codes of a whole election don't need to be held in memory: a CodeExport
+sorts them in runs of a fixed size, keeps each run in a temporary file as
+the ballots are verified, and merges the runs when the CSV file is written.
+
+The same codes can be written as an index, an SQLite file keyed by web serial number,
+so that the codes of one ballot are found without going through the whole list.
+
+Usage, to look up web serial numbers in an index:
+python codes.py <INDEX_FILE> <WEB_SERIAL> ...
+python codes.py <INDEX_FILE> --serials <SERIALS_FILE>
+
+The SERIALS_FILE has one web serial number per line. Each one found is printed as
+its line of the codes file, the others as "<WEB_SERIAL>,not found", in which case
+the exit status is 1.
+"""
+
+import sys, os, heapq, itertools, marshal, tempfile, sqlite3
+
+# the number of codes sorted in memory before they go to a temporary file
+RUN_SIZE = 100000
+
+# the number of codes read back from a temporary file at a time
+BLOCK_SIZE = 1000
+
+def _read_run(run_file):
+  """
+  the records of a run, in the order they were written, which is in blocks of records
+  """
+  run_file.seek(0)
+  while True:
+    try:
+      block = marshal.load(run_file)
+    except EOFError:
+      return
+    for record in block:
+      yield record
+
+def format_ballot(serial, pid, questions):
+  """
+  the line of the codes file for one web serial number, without the end of line
+  """
+  line = '%s,%s' % (serial, pid)
+  for q_id in sorted(questions.keys()):
+    line += ',"%s"' % ",".join(questions[q_id])
+  return line
+
+class CodeExport(object):
+  """
+  The codes of the ballots that verify, by web serial number.
+
+  new_code is a code_callback_func for Ballot.verify_code_openings, and write
+  writes the CSV file: one line per web serial number, in order, with the P table ID
+  and the codes of each question in the order they were verified.
+  """
+  def __init__(self, run_size=None):
+    if run_size is None:
+      run_size = RUN_SIZE
+    self.run_size = run_size
+
+    self.num_codes = 0
+    self.__run = []
+    self.__run_files = []
+
+  def new_code(self, webSerial, pid, q_id, s_id, confirmation_code):
+    # the count keeps the codes of each web serial number in the order they came in
+    self.__run.append((webSerial, self.num_codes, pid, q_id, confirmation_code))
+    self.num_codes += 1
+
+    if len(self.__run) >= self.run_size:
+      self.__spill()
+
+  def __spill(self):
+    """
+    sort the run in memory and move it to a temporary file
+    """
+    self.__run.sort()
+    run_file = tempfile.TemporaryFile(prefix='codes-')
+    for i in range(0, len(self.__run), BLOCK_SIZE):
+      marshal.dump(self.__run[i:i + BLOCK_SIZE], run_file)
+    self.__run_files.append(run_file)
+    self.__run = []
+
+  def records(self):
+    """
+    all the (webSerial, count, pid, question_id, confirmation_code) records so far, sorted
+    """
+    self.__run.sort()
+    return heapq.merge(self.__run, *[_read_run(run_file) for run_file in self.__run_files])
+
+  def ballots(self):
+    """
+    the (webSerial, pid, {question_id: [confirmation_code, ...]}) of each web serial number, in order
+    """
+    for serial, serial_records in itertools.groupby(self.records(), lambda record: record[0]):
+      questions = {}
+      pid = None
+      for webSerial, count, record_pid, q_id, confirmation_code in serial_records:
+        # the P table ID of the first ballot with this serial number, as there should be only one
+        if pid is None:
+          pid = record_pid
+        questions.setdefault(q_id, []).append(confirmation_code)
+      yield serial, pid, questions
+
+  def write(self, codes_output_stream):
+    ballots = self.ballots()
+    first_ballot = next(ballots, None)
+
+    # the header has the questions of the first ballot
+    codes_output_stream.write('Serial #,P-table ID')
+    if first_ballot:
+      for q_id in sorted(first_ballot[2].keys()):
+        codes_output_stream.write(",question %s"%q_id)
+    codes_output_stream.write("\n")
+
+    if first_ballot:
+      for serial, pid, questions in itertools.chain([first_ballot], ballots):
+        codes_output_stream.write(format_ballot(serial, pid, questions) + "\n")
+
+  def write_index(self, index_path):
+    write_index(index_path, self.ballots())
+
+  def close(self):
+    """
+    remove the temporary files
+    """
+    for run_file in self.__run_files:
+      run_file.close()
+    self.__run_files = []
+    self.__run = []
+
+##
+## the index, for looking up the codes of a ballot
+##
+
+def write_index(index_path, ballots):
+  """
+  write the (webSerial, pid, questions) ballots, as CodeExport.ballots gives them,
+  to a new index at index_path. It replaces the file only once it is complete.
+
+  The P table IDs are kept as the text of the codes file, so a lookup gives the same line.
+  """
+  # a temporary file of its own, so that concurrent runs don't write over each other's
+  fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(index_path) + '.', suffix='.tmp',
+                                  dir=os.path.dirname(os.path.abspath(index_path)))
+  os.close(fd)
+
+  try:
+    db = sqlite3.connect(tmp_path)
+    try:
+      db.execute("PRAGMA journal_mode = OFF")
+      db.execute("PRAGMA synchronous = OFF")
+      db.execute("""CREATE TABLE codes (serial TEXT NOT NULL, pid TEXT NOT NULL, question_id TEXT NOT NULL,
+                    codes TEXT NOT NULL, PRIMARY KEY (serial, question_id))""")
+      db.executemany("INSERT INTO codes VALUES (?, ?, ?, ?)",
+                     ((serial, "%s" % pid, q_id, ",".join(question_codes))
+                      for serial, pid, questions in ballots for q_id, question_codes in questions.iteritems()))
+      db.commit()
+    finally:
+      db.close()
+    os.rename(tmp_path, index_path)
+  except:
+    os.remove(tmp_path)
+    raise
+
+class CodeIndex(object):
+  """
+  the lookups in an index written by write_index
+  """
+  def __init__(self, index_path):
+    if not os.path.exists(index_path):
+      raise IOError("no index at %s" % index_path)
+    self.db = sqlite3.connect(index_path)
+    self.db.text_factory = str
+
+  def lookup(self, serial):
+    """
+    the (pid, {question_id: [confirmation_code, ...]}) of a web serial number, None if it isn't there
+    """
+    pid = None
+    questions = {}
+    for pid, q_id, question_codes in self.db.execute("SELECT pid, question_id, codes FROM codes WHERE serial = ?", (serial,)):
+      questions[q_id] = question_codes.split(",")
+
+    if pid is None:
+      return None
+    return pid, questions
+
+  def lookup_many(self, serials):
+    """
+    (serial, lookup(serial)) for each of the serials in turn, which can be a file
+    of one serial number per line, read as it goes
+    """
+    for serial in serials:
+      serial = serial.strip()
+      if serial:
+        yield serial, self.lookup(serial)
+
+  def close(self):
+    self.db.close()
+
+if __name__ == '__main__':
+  index = CodeIndex(sys.argv[1])
+
+  if sys.argv[2:3] == ['--serials']:
+    serials = open(sys.argv[3])
+  else:
+    serials = sys.argv[2:]
+
+  all_found = True
+  for serial, found in index.lookup_many(serials):
+    if found:
+      pid, questions = found
+      print format_ballot(serial, pid, questions)
+    else:
+      print "%s,not found" % serial
+      all_found = False
+
+  index.close()
+
+  if not all_found:
+    sys.exit(1)
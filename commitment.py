@@ -60,6 +60,39 @@ def commit(message, key_b64, constant):
   
   # concatenate and encode
   return base64.b64encode(h1 + h2)
+
+def _commit_binary(message, key, constant):
+  """
+  the same commitment as commit(), with a decoded key and binary output, no debugging
+  """
+  sak = AES.new(key, AES.MODE_ECB).encrypt(constant)
+  h1 = hashlib.sha256(message + sak).digest()
+  return h1 + hashlib.sha256(message + AES.new(sak, AES.MODE_ECB).encrypt(h1)).digest()
+
+def verify_many(items, constant):
+  """
+  check a batch of commitment openings with the same constant.
+
+  items is an iterable of (message, key_b64, expected_b64) tuples.
+  Return a list of booleans, one per item, in order: True if the opening
+  matches the expected commitment exactly, as base64 text, like commit() does.
+  An item that can't even be decoded fails rather than interrupting the batch.
+  """
+  b64decode, b64encode = base64.b64decode, base64.b64encode
+  results = []
+  for message, key_b64, expected_b64 in items:
+    try:
+      results.append(b64encode(_commit_binary(message, b64decode(key_b64), constant)) == expected_b64)
+    except (TypeError, ValueError):
+      results.append(False)
+  return results
+
+def verify_shard(shard):
+  """
+  verify_many on an (items, constant) pair, the form base.parallel_map hands out
+  """
+  items, constant = shard
+  return verify_many(items, constant)
   
 ##
 ## TEST VECTOR
@@ -80,3 +113,8 @@ if __name__ == '__main__':
     print "GOOD!"
   else:
     print "BAD :("
+
+  if verify_many([(message, key_b64, expected_b64), (message, key_b64, result[::-1])], constant) == [True, False]:
+    print "GOOD batch!"
+  else:
+    print "BAD batch :("
@@ -5,9 +5,11 @@ ben@adida.net
 2009-10-10
 """
 
-import base64
+import base64, bisect, json
+from array import array
+from collections import OrderedDict
 from xml.etree import ElementTree
-import commitment
+import base, commitment, filenames, batch
 
 def _compare_positions(element_1, element_2):
   """
@@ -72,6 +74,87 @@ def walk_permutation_map(p_map, func, running_data):
   else:
     return func(p_map, running_data)
   
+class SlicePlan(object):
+  """
+  The layout of a permutation map (see split_permutations), worked out once:
+  where each leaf permutation starts and stops in the concatenation.
+  
+  slices mirrors the tree of the map with a (start, stop) pair at each leaf,
+  leaves lists those pairs in order, and width is the total length.
+  For a map of partitions, e.g. [[2],[3,4]], parts has a plan for each partition,
+  with offsets relative to the start of that partition, and bounds says where
+  each partition starts and stops in the whole.
+  """
+  
+  def __init__(self, partition_map):
+    self.partition_map = partition_map
+    self.leaves = []
+    
+    def leaf_slice(p_map, current_index):
+      new_index = current_index + p_map
+      self.leaves.append((current_index, new_index))
+      return (current_index, new_index), new_index
+      
+    self.slices, self.width = walk_permutation_map(partition_map, leaf_slice, 0)
+    
+    # a list of ints, or a list of lists of ints, can be split faster
+    is_flat = lambda p_map: type(p_map) == list and not [el for el in p_map if type(el) == list]
+    self.__flat = is_flat(partition_map)
+    self.__two_levels = type(partition_map) == list and not [el for el in partition_map if not is_flat(el)]
+    
+    self.parts = []
+    self.bounds = []
+    if type(partition_map) == list and not [el for el in partition_map if type(el) != list]:
+      offset = 0
+      for sub_map in partition_map:
+        part = SlicePlan(sub_map)
+        self.parts.append(part)
+        self.bounds.append((offset, offset + part.width))
+        offset += part.width
+    
+  def split(self, concatenated_permutations):
+    """
+    split one row's concatenated permutations according to the plan
+    """
+    # the two shapes we see all the time, for speed
+    if self.__flat:
+      return [concatenated_permutations[start:stop] for start, stop in self.slices]
+    if self.__two_levels:
+      return [[concatenated_permutations[start:stop] for start, stop in partition] for partition in self.slices]
+    
+    def subperm(leaf, running_data):
+      return concatenated_permutations[leaf[0]:leaf[1]], running_data
+    return walk_permutation_map(self.slices, subperm, None)[0]
+  
+  def split_column(self, column):
+    """
+    split a whole column, a list of rows of concatenated permutations or a 2-D array.
+    Returns the tree of the map with, at each leaf, that leaf's slice of every row.
+    """
+    if hasattr(column, 'shape'):
+      leaf_column = lambda start, stop: column[:, start:stop]
+    else:
+      leaf_column = lambda start, stop: [row[start:stop] for row in column]
+      
+    def subcolumn(leaf, running_data):
+      return leaf_column(leaf[0], leaf[1]), running_data
+    return walk_permutation_map(self.slices, subcolumn, None)[0]
+
+# plans for the maps handed to split_permutations directly, by their representation
+_SLICE_PLANS = {}
+
+def slice_plan(partition_map):
+  """
+  the SlicePlan for a permutation map, or the plan itself if it's already one
+  """
+  if isinstance(partition_map, SlicePlan):
+    return partition_map
+  
+  key = repr(partition_map)
+  if not _SLICE_PLANS.has_key(key):
+    _SLICE_PLANS[key] = SlicePlan(partition_map)
+  return _SLICE_PLANS[key]
+  
 def split_permutations(concatenated_permutations, partition_map):
   """
   Given concatenated permutations [0 1 2 0 1 0 2 3 1] and a partition_map, i.e. [[2],[3,4]],
@@ -80,17 +163,10 @@ def split_permutations(concatenated_permutations, partition_map):
   This is also used to split the p3 column of the P table and the d3 column of the D table,
   where instead of permutations, we are dealing with actual voter selections of candidates.
   In that case, the partition map should list the max_num_answers, not the total_num_answers.
-  """
   
-  # a function to extract the permutation when we get to the leaf
-  # current_index is the running_data that keeps track of where we are
-  # in the tree. Note that this assumes depth-first traversal, without
-  # parallelization (likely a safe assumption.)
-  def subperm(p_map, current_index):
-    new_index = current_index + p_map
-    return concatenated_permutations[current_index:new_index], new_index
-  
-  return walk_permutation_map(partition_map, subperm, 0)[0]
+  The partition_map can also be given as its SlicePlan, which saves working out the layout again.
+  """
+  return slice_plan(partition_map).split(concatenated_permutations)
   
 def compose_lists_of_permutations(list_of_perms_1, list_of_perms_2):
   """
@@ -103,45 +179,65 @@ def compose_lists_of_permutations(list_of_perms_1, list_of_perms_2):
 ## Verification of Symbols Depending on question type
 ##
 
-def __remove_minus_one_on(array):
+def _MULTIPLE_check_encodings(p_3, symbols, counts, max_num_answers):
+  # should be the symbols in any order, followed by -1,
+  # HACK for now, since we care only about rank
+  return []
+
+# for each type of question, the check of the open symbols of many ballots
+# against their p3 entries, which returns the positions of the ballots that don't match
+CHECK_ENCODINGS = {}
+CHECK_ENCODINGS['rank'] = batch.check_rank_encodings
+CHECK_ENCODINGS['one_answer'] = batch.check_single_encodings
+CHECK_ENCODINGS['multiple_answers'] = _MULTIPLE_check_encodings
+
+def encoding_failures(election, ballots_and_choices):
   """
-  remove everything after a minus one
+  check that the open symbols of many ballots correspond to their p3 entries, given as
+  a list of (ballot, p3 column of its P table row split by election.partition_plan_choices).
+  The ballots are checked together, one question at a time, with CHECK_ENCODINGS.
+
+  Returns the sorted pids of the ballots that don't match.
   """
-  try:
-    pos = array.index(-1)
-    return array[:pos]
-  except:
-    return array
+  failing = set()
 
-def _RANK_verify_symbols(ballot_symbols, p_table_symbols, question):
-  mx = question.max_num_answers
-  # p_table_symbols_processed = __remove_minus_one_on(p_table_symbols)
-  for symbol in ballot_symbols:
-    try:
-      if p_table_symbols[symbol % mx] != symbol / mx:
-        return False
-    except:
-      import pdb; pdb.set_trace()
-      
-  # check that the number of symbols that are not -1 is equal to the number of symbols
-  if len([p for p in p_table_symbols if p != -1]) != len(ballot_symbols):
-    import pdb; pdb.set_trace()
-    return False
-  
-  return True
+  # for each question, the pids, the p3 entries, and the symbols of the ballots, to check together
+  by_question = {}
+  for ballot, encoded_choices in ballots_and_choices:
+    for q_id, question in ballot.questions.iteritems():
+      # a question with no open symbols has nothing to check
+      if not question:
+        continue
 
-def _SINGLE_verify_symbols(ballot_symbols, p_table_symbols, question):
-  return ballot_symbols == __remove_minus_one_on(p_table_symbols)
-  
-def _MULTIPLE_verify_symbols(ballot_symbols, p_table_symbols, question):
-  #return sorted(ballot_symbols) == sorted(__remove_minus_one_on(p_table_symbols))
-  # HACK for now, since we care only about rank
-  return True
+      if not election.spec.questions_by_id.has_key(q_id):
+        failing.add(ballot.pid)
+        continue
+      q_info = election.spec.questions_by_id[q_id]
+
+      try:
+        p_table_symbols = encoded_choices[q_info.partition_num][q_info.position_in_partition]
+      except IndexError:
+        failing.add(ballot.pid)
+        continue
+
+      if len(p_table_symbols) != q_info.max_num_answers:
+        failing.add(ballot.pid)
+        continue
+
+      if not by_question.has_key(q_id):
+        by_question[q_id] = ([], [], [], [])
+      pids, p_3, symbols, counts = by_question[q_id]
+      pids.append(ballot.pid)
+      p_3.append(p_table_symbols)
+      symbols.extend(question.keys())
+      counts.append(len(question))
 
-VERIFY_SYMBOLS = {}
-VERIFY_SYMBOLS['rank'] = _RANK_verify_symbols
-VERIFY_SYMBOLS['one_answer'] = _SINGLE_verify_symbols
-VERIFY_SYMBOLS['multiple_answers'] = _MULTIPLE_verify_symbols
+  for q_id, (pids, p_3, symbols, counts) in by_question.iteritems():
+    q_info = election.spec.questions_by_id[q_id]
+    positions = CHECK_ENCODINGS[q_info.type_answer_choice](batch.stack(p_3), symbols, counts, q_info.max_num_answers)
+    failing.update([pids[position] for position in positions])
+
+  return sorted(failing)
 
 ##
 ## Data Structures
@@ -254,7 +350,6 @@ class ElectionSpec(object):
 
     # check match of election IDs
     if self.partition_info and self.partition_info.id != self.id:
-      import pdb; pdb.set_trace()
       raise Exception("election IDs don't match")
     
     # initialize the questions_by_partition
@@ -291,13 +386,27 @@ class Election(object):
     self.constant = None
     self.spec = election_spec
     
-  @property
-  def partition_map(self):
+    # the maps and their plans only depend on the spec, so they're worked out once
+    self.__partition_map = None
+    self.__partition_map_choices = None
+    self.__partition_plan = None
+    self.__partition_plan_choices = None
+    
+  def __map(self, question_leaf):
     # list of lists of dictionaries, each dictionary contains the question and section IDs
     partitions = self.spec.partition_info.partitions
     
-    # look up the number of answers for each question within each section
-    return [[len(self.spec.sections[q_info['section_id']][q_info['question_id']].answers) for q_info in partition] for partition in partitions]
+    # look up the question within each section
+    return [[question_leaf(self.spec.sections[q_info['section_id']][q_info['question_id']]) for q_info in partition] for partition in partitions]
+    
+  @property
+  def partition_map(self):
+    """
+    for each partition, the number of answers for each question
+    """
+    if self.__partition_map is None:
+      self.__partition_map = self.__map(lambda question: len(question.answers))
+    return self.__partition_map
 
   @property
   def partition_map_choices(self):
@@ -305,11 +414,27 @@ class Election(object):
     same as partition map, only with the max num of selected answers for each question,
     rather than the total num of answers to choose from. Useful for parsing the voter selection.
     """
-    # list of lists of dictionaries, each dictionary contains the question and section IDs
-    partitions = self.spec.partition_info.partitions
-
-    # look up the number of answers for each question within each section
-    return [[self.spec.sections[q_info['section_id']][q_info['question_id']].max_num_answers for q_info in partition] for partition in partitions]
+    if self.__partition_map_choices is None:
+      self.__partition_map_choices = self.__map(lambda question: question.max_num_answers)
+    return self.__partition_map_choices
+    
+  @property
+  def partition_plan(self):
+    """
+    the SlicePlan of partition_map
+    """
+    if self.__partition_plan is None:
+      self.__partition_plan = SlicePlan(self.partition_map)
+    return self.__partition_plan
+  
+  @property
+  def partition_plan_choices(self):
+    """
+    the SlicePlan of partition_map_choices
+    """
+    if self.__partition_plan_choices is None:
+      self.__partition_plan_choices = SlicePlan(self.partition_map_choices)
+    return self.__partition_plan_choices
 
   @property
   def num_partitions(self):
@@ -332,43 +457,500 @@ class Election(object):
     self.num_ballots = int(etree.findtext('noBallots'))
     self.constant = base64.decodestring(etree.findtext('constant'))
 
+##
+## compact, column-oriented storage of table rows
+##
+
+class _Column(object):
+  """
+  One field of all the rows of a table, stored densely by row position.
+  
+  Values that don't fit the column's compact form are kept aside as they are,
+  and rows that don't have the field at all are remembered as missing.
+  """
+  def __init__(self):
+    self.size = 0
+    self.irregular = {}
+    self.missing = set()
+    
+  def append(self, value):
+    self.size += 1
+    self._grow()
+    self.set(self.size - 1, value)
+  
+  def append_missing(self):
+    self.size += 1
+    self._grow()
+    self.missing.add(self.size - 1)
+    
+  def set(self, position, value):
+    self.missing.discard(position)
+    self.irregular.pop(position, None)
+    if not self._set(position, value):
+      self.irregular[position] = value
+      
+  def set_missing(self, position):
+    self.irregular.pop(position, None)
+    self.missing.add(position)
+  
+  def get(self, position):
+    if position in self.irregular:
+      return self.irregular[position]
+    return self._get(position)
+    
+class _PermutationColumn(_Column):
+  """
+  permutations of a fixed width, as one flat array of small integers.
+  int8 to start with, widened to int16 if some value doesn't fit.
+  The width is set by the first permutation that comes in.
+  """
+  def __init__(self):
+    _Column.__init__(self)
+    self.width = None
+    self.values = array('b')
+  
+  def _grow(self):
+    if self.width is not None:
+      self.values.extend([0] * (self.size * self.width - len(self.values)))
+  
+  def _set(self, position, value):
+    if type(value) != list:
+      return False
+    if self.width is None:
+      self.width = len(value)
+      self._grow()
+    if len(value) != self.width:
+      return False
+    
+    try:
+      self.values[position * self.width:(position + 1) * self.width] = array(self.values.typecode, value)
+    except OverflowError:
+      if self.values.typecode != 'b':
+        return False
+      self.values = array('h', self.values)
+      return self._set(position, value)
+    return True
+  
+  def _get(self, position):
+    return self.values[position * self.width:(position + 1) * self.width].tolist()
+
+class _CommitmentColumn(_Column):
+  """
+  base64 commitments, stored as fixed-size binary strings, 64 bytes for a pair of SHA256 hashes
+  """
+  SIZE = 64
+  
+  def __init__(self):
+    _Column.__init__(self)
+    self.values = bytearray()
+    
+  def _grow(self):
+    self.values.extend('\0' * (self.size * self.SIZE - len(self.values)))
+  
+  def _set(self, position, value):
+    try:
+      decoded = base64.b64decode(value)
+    except (TypeError, ValueError):
+      return False
+      
+    # only keep it binary if it comes back exactly the same
+    if len(decoded) != self.SIZE or base64.b64encode(decoded) != value:
+      return False
+    
+    self.values[position * self.SIZE:(position + 1) * self.SIZE] = decoded
+    return True
+    
+  def _get(self, position):
+    return base64.b64encode(str(self.values[position * self.SIZE:(position + 1) * self.SIZE]))
+
+class _IntegerColumn(_Column):
+  def __init__(self):
+    _Column.__init__(self)
+    self.values = array('l')
+  
+  def _grow(self):
+    self.values.extend([0] * (self.size - len(self.values)))
+    
+  def _set(self, position, value):
+    try:
+      self.values[position] = value
+    except (TypeError, OverflowError):
+      return False
+    return True
+  
+  def _get(self, position):
+    return self.values[position]
+
+class _ValueColumn(_Column):
+  """
+  anything else, salts and such, kept as is
+  """
+  def __init__(self):
+    _Column.__init__(self)
+    self.values = []
+  
+  def _grow(self):
+    self.values.extend([None] * (self.size - len(self.values)))
+    
+  def _set(self, position, value):
+    self.values[position] = value
+    return True
+    
+  def _get(self, position):
+    return self.values[position]
+
+class CompactRows(object):
+  """
+  The rows of a table stored by column rather than as one dictionary per row:
+  an array of row IDs, a fixed-width int8/int16 array per permutation field,
+  64-byte binary strings for the commitments, and integer arrays for the integer fields.
+  
+  It behaves like the dictionary of rows keyed by row ID it replaces, but each
+  row comes back as a new dictionary rebuilt from the columns, so changing it
+  doesn't change the table.
+  """
+  
+  COMMITMENT_FIELDS = ['c1', 'c2', 'cl', 'cr']
+  
+  def __init__(self, permutation_fields=(), integer_fields=()):
+    self.permutation_fields = permutation_fields
+    self.integer_fields = integer_fields
+    
+    # row IDs by position. As long as they come in increasing order,
+    # we find positions by binary search, otherwise we need a real index
+    self.__ids = array('l')
+    self.__positions = None
+    
+    self.__columns = {}
+    
+  def __new_column(self, field):
+    if field in self.permutation_fields:
+      column = _PermutationColumn()
+    elif field in self.COMMITMENT_FIELDS:
+      column = _CommitmentColumn()
+    elif field in self.integer_fields:
+      column = _IntegerColumn()
+    else:
+      column = _ValueColumn()
+    
+    # the rows so far didn't have this field
+    for i in range(len(self.__ids)):
+      column.append_missing()
+      
+    self.__columns[field] = column
+    return column
+  
+  def __position(self, row_id):
+    if self.__positions is not None:
+      return self.__positions.get(row_id)
+    
+    i = bisect.bisect_left(self.__ids, row_id)
+    if i < len(self.__ids) and self.__ids[i] == row_id:
+      return i
+    return None
+    
+  def __row(self, position):
+    return dict([(field, column.get(position)) for field, column in self.__columns.iteritems() if position not in column.missing])
+    
+  def __setitem__(self, row_id, row):
+    position = self.__position(row_id)
+    
+    # replacing a row we already have
+    if position is not None:
+      for field, column in self.__columns.iteritems():
+        if row.has_key(field):
+          column.set(position, row[field])
+        else:
+          column.set_missing(position)
+      for field in row.keys():
+        if not self.__columns.has_key(field):
+          self.__new_column(field).set(position, row[field])
+      return
+    
+    # a new row
+    for field, column in self.__columns.iteritems():
+      if row.has_key(field):
+        column.append(row[field])
+      else:
+        column.append_missing()
+    for field in row.keys():
+      if not self.__columns.has_key(field):
+        self.__new_column(field).append(row[field])
+    
+    if self.__positions is None and len(self.__ids) and row_id < self.__ids[-1]:
+      self.__positions = dict([(r_id, i) for i, r_id in enumerate(self.__ids)])
+    if self.__positions is not None:
+      self.__positions[row_id] = len(self.__ids)
+    self.__ids.append(row_id)
+    
+  def __getitem__(self, row_id):
+    position = self.__position(row_id)
+    if position is None:
+      raise KeyError(row_id)
+    return self.__row(position)
+  
+  def get(self, row_id, default=None):
+    position = self.__position(row_id)
+    if position is None:
+      return default
+    return self.__row(position)
+    
+  def has_key(self, row_id):
+    return self.__position(row_id) is not None
+  
+  __contains__ = has_key
+  
+  def __len__(self):
+    return len(self.__ids)
+  
+  def iterkeys(self):
+    return iter(self.__ids)
+    
+  __iter__ = iterkeys
+  
+  def keys(self):
+    return self.__ids.tolist()
+  
+  def itervalues(self):
+    for position in xrange(len(self.__ids)):
+      yield self.__row(position)
+  
+  def values(self):
+    return list(self.itervalues())
+    
+  def iteritems(self):
+    for position, row_id in enumerate(self.__ids):
+      yield row_id, self.__row(position)
+  
+  def items(self):
+    return list(self.iteritems())
+
+  def permutation_array(self, field):
+    """
+    a permutation field of every row, in order, as a 2-D array read straight from its column,
+    None if it can't be: without NumPy, or if some rows don't have it in the compact form
+    """
+    column = self.__columns.get(field)
+    if not batch.numpy or not isinstance(column, _PermutationColumn) or column.width is None \
+       or column.irregular or column.missing:
+      return None
+
+    dtype = {'b': batch.numpy.int8, 'h': batch.numpy.int16}[column.values.typecode]
+    return batch.numpy.frombuffer(column.values, dtype=dtype).reshape(len(self.__ids), column.width)
+
+_JSON_DECODER = json.JSONDecoder()
+
+def decode_permutation(text):
+  """
+  a permutation field as it is in the XML, integers separated by spaces, as a list.
+  Text of just digits, minus signs and spaces is read by the JSON decoder, which is
+  much faster than int() on each element. Anything else it doesn't read the same
+  way, like leading zeros, goes through int() as it always has.
+  """
+  if type(text) == str and text and not text.translate(None, '0123456789- '):
+    try:
+      return _JSON_DECODER.raw_decode('[' + text.replace(' ', ',') + ']')[0]
+    except ValueError:
+      pass
+  return [int(el) for el in text.split(' ')]
+
+class Row(object):
+  """
+  A table row, read like a dictionary of its fields, with its permutation fields kept as
+  the text they were parsed from until they are first read, then decoded once with
+  decode_permutation. Rows that are never looked at never pay for decoding, nor for the
+  memory of the lists.
+  
+  It isn't a dict, so that the fields can't be read but decoded: iterating over a row,
+  copying it and comparing it all go through __getitem__. raw() is the only way to the text.
+  """
+  __slots__ = ('fields', 'permutation_fields')
+  
+  def __init__(self, fields=(), permutation_fields=()):
+    self.fields = dict(fields)
+    self.permutation_fields = permutation_fields
+  
+  def __getitem__(self, field):
+    value = self.fields[field]
+    if value.__class__ in (str, unicode) and field in self.permutation_fields:
+      value = self.fields[field] = decode_permutation(value)
+    return value
+  
+  def raw(self, field):
+    """
+    a field as it is kept, the text of a permutation field that wasn't read yet
+    """
+    return self.fields[field]
+  
+  def __setitem__(self, field, value):
+    self.fields[field] = value
+  
+  def __delitem__(self, field):
+    del self.fields[field]
+  
+  def get(self, field, default=None):
+    if not self.fields.has_key(field):
+      return default
+    return self[field]
+  
+  def has_key(self, field):
+    return self.fields.has_key(field)
+  
+  __contains__ = has_key
+  
+  def __len__(self):
+    return len(self.fields)
+  
+  def __iter__(self):
+    return iter(self.fields)
+  
+  def keys(self):
+    return self.fields.keys()
+  
+  def iteritems(self):
+    for field in self.fields.keys():
+      yield field, self[field]
+  
+  def items(self):
+    return list(self.iteritems())
+  
+  def itervalues(self):
+    for field, value in self.iteritems():
+      yield value
+  
+  def values(self):
+    return list(self.itervalues())
+  
+  def copy(self):
+    return Row(self.fields, self.permutation_fields)
+  
+  def __eq__(self, other):
+    if isinstance(other, Row):
+      other = dict(other.items())
+    return dict(self.items()) == other
+  
+  def __ne__(self, other):
+    return not self == other
+  
+  __hash__ = None
+  
+  def __repr__(self):
+    return repr(dict(self.items()))
+  
+  def __getstate__(self):
+    return self.fields, self.permutation_fields
+  
+  def __setstate__(self, state):
+    self.fields, self.permutation_fields = state
+
 class Table(object):
   """
   A base table class that has features that P, D, and R tables all need
+  
+  With compact (base.COMPACT_TABLES, --compact-tables, by default), the rows are
+  stored by column in a CompactRows rather than in a dictionary of dictionaries.
+  
+  The permutations of a row, split by get_permutations_by_row_id, are kept for the
+  last cache_size rows asked for (base.PERMUTATION_CACHE_SIZE, --permutation-cache N,
+  by default), and cache_info() tells how often they were found there.
   """
   
   # fields that are to be interpreted as permutations
   PERMUTATION_FIELDS = []
   INTEGER_FIELDS = ['id']
   
-  def __init__(self):
+  def __init__(self, compact=None, cache_size=None):
+    if compact is None:
+      compact = base.COMPACT_TABLES
+    if cache_size is None:
+      cache_size = base.PERMUTATION_CACHE_SIZE
+      
     self.id = None
-    self.rows = {}
-    self.__permutations_by_row_id = {}
+    if compact:
+      self.rows = CompactRows(self.PERMUTATION_FIELDS, self.INTEGER_FIELDS)
+    else:
+      self.rows = {}
+    
+    # split permutations by (row ID, slice plan), least recently used first
+    self.cache_size = cache_size
+    self.cache_hits = 0
+    self.cache_misses = 0
+    self.__permutations_by_row_id = OrderedDict()
     
   @classmethod
   def process_row(cls, row):
     """
-    for the fields that are interpreted as permutations,
-    do proper splitting on spaces to create python lists
+    the row for a dictionary of fields, with the fields that are interpreted
+    as permutations to be split on spaces into python lists when they are read
     """
-    for f in cls.PERMUTATION_FIELDS:
-      if row.has_key(f):
-        row[f] = [int(el) for el in row[f].split(' ')]
-    
-    return row
+    return Row(row, cls.PERMUTATION_FIELDS)
 
   def get_permutations_by_row_id(self, row_id, pmap):
-    # already computed?
-    if not self.__permutations_by_row_id.has_key(row_id):
-      self.__permutations_by_row_id[row_id] = new_row = []
-      for perm_field in self.PERMUTATION_FIELDS:
-        if self.rows[row_id].has_key(perm_field):
-          new_row.append(split_permutations(self.rows[row_id][perm_field], pmap))
-        else:
-          new_row.append(None)
+    """
+    the permutation fields of a row, each split according to pmap,
+    a permutation map or better its SlicePlan
+    """
+    plan = slice_plan(pmap)
+    key = (row_id, plan)
+    
+    # already computed? it's now the most recently used
+    if key in self.__permutations_by_row_id:
+      self.cache_hits += 1
+      new_row = self.__permutations_by_row_id.pop(key)
+      self.__permutations_by_row_id[key] = new_row
+      return new_row
+    
+    self.cache_misses += 1
+    row = self.rows[row_id]
+    new_row = []
+    for perm_field in self.PERMUTATION_FIELDS:
+      if row.has_key(perm_field):
+        new_row.append(plan.split(row[perm_field]))
+      else:
+        new_row.append(None)
+    
+    self.__permutations_by_row_id[key] = new_row
+    if len(self.__permutations_by_row_id) > self.cache_size:
+      self.__permutations_by_row_id.popitem(last=False)
+    
+    return new_row
+  
+  def permutation_array(self, field):
+    """
+    a permutation field of every row, in the order of rows.itervalues(), as a 2-D array
+    with a row per table row (see batch.stack). The fields not read yet are read all at once.
+    Raises ValueError if some rows don't have it, or the rows aren't all as long.
+    """
+    if isinstance(self.rows, CompactRows):
+      stacked = self.rows.permutation_array(field)
+      if stacked is not None:
+        return stacked
+
+    fields = []
+    for row in self.rows.itervalues():
+      if not row.has_key(field):
+        raise ValueError("row %s has no %s" % (row.get('id'), field))
+      # the text of the field, if it hasn't been decoded yet
+      fields.append(row.raw(field))
+    return batch.stack_fields(fields)
 
-    return self.__permutations_by_row_id[row_id]
+  def cache_info(self):
+    """
+    (hits, misses, rows kept, most rows kept) of the split permutations
+    """
+    return self.cache_hits, self.cache_misses, len(self.__permutations_by_row_id), self.cache_size
+    
+  def parse_row(self, row_el):
+    new_row = self.process_row(row_el.attrib)      
+    
+    # convert fields to ints when it matters
+    for k in self.INTEGER_FIELDS:
+      if new_row.has_key(k):
+        new_row[k] = int(new_row[k])
+    
+    # the row is complete before it's stored, the compact rows keep a copy
+    self.rows[new_row['id']] = new_row
+    return new_row
     
   def parse(self, etree):
     if etree.attrib.has_key('id'):
@@ -376,65 +958,105 @@ class Table(object):
     
     # look for all rows
     for row_el in etree.findall('row'):
-      self.rows[int(row_el.attrib['id'])] = new_row = self.process_row(row_el.attrib)      
-      
-      # convert fields to ints when it matters
-      for k in self.INTEGER_FIELDS:
-        if new_row.has_key(k):
-          new_row[k] = int(new_row[k])
+      self.parse_row(row_el)
   
 class PTable(Table):
   PERMUTATION_FIELDS = ['p1', 'p2', 'p3']
       
   @classmethod
-  def __check_commitment(cls, commitment_str, row_id, permutation, salt, constant):
+  def __commitment_message(cls, row_id, permutation):
     """
-    check the reveal of a commitment to a permutation,
+    prepare the string that we are committing to
     """
-    # prepare the string that we are committing to
-    message = str(row_id)
-    message += ''.join([chr(el) for el in permutation])
-
-    # reperform commitment and check equality
-    return commitment_str == commitment.commit(message, salt, constant)
+    return str(row_id) + ''.join([chr(el) for el in permutation])
+    
+  def c1_opening(self, reveal_row):
+    """
+    the (message, salt, commitment) opening of c1, as commitment.verify_many expects it
+    """
+    return (self.__commitment_message(reveal_row['id'], reveal_row['p1']), reveal_row['s1'], self.rows[reveal_row['id']]['c1'])
+  
+  def c2_opening(self, reveal_row):
+    return (self.__commitment_message(reveal_row['id'], reveal_row['p2']), reveal_row['s2'], self.rows[reveal_row['id']]['c2'])
+    
+  def full_row_openings(self, reveal_row):
+    return [self.c1_opening(reveal_row), self.c2_opening(reveal_row)]
     
   def check_c1(self, reveal_row, constant):
-    return self.__check_commitment(self.rows[reveal_row['id']]['c1'], reveal_row['id'], reveal_row['p1'], reveal_row['s1'], constant)
+    return commitment.verify_many([self.c1_opening(reveal_row)], constant)[0]
   
   def check_c2(self, reveal_row, constant):
-    return self.__check_commitment(self.rows[reveal_row['id']]['c2'], reveal_row['id'], reveal_row['p2'], reveal_row['s2'], constant)
+    return commitment.verify_many([self.c2_opening(reveal_row)], constant)[0]
     
   def check_full_row(self, reveal_row, constant):
-    return self.check_c1(reveal_row, constant) and self.check_c2(reveal_row, constant)
+    return all(commitment.verify_many(self.full_row_openings(reveal_row), constant))
     
 
 class DTable(Table):
+  """
+  A D table, with its rows also indexed by pid and by rid, the P and R table rows
+  they link to. Those are one-to-one, so any value found on more than one row is
+  recorded as a duplicate, and only its first row is indexed.
+  """
   PERMUTATION_FIELDS = ['d2', 'd3', 'd4']
   INTEGER_FIELDS = ['id', 'pid', 'rid']
 
+  def __init__(self, compact=None, cache_size=None):
+    Table.__init__(self, compact, cache_size)
+    
+    # row ID by pid and by rid, and the pids and rids that are on more than one row
+    self.by_pid = {}
+    self.by_rid = {}
+    self.duplicate_pids = []
+    self.duplicate_rids = []
+    
+  @classmethod
+  def __index(cls, index, duplicates, row, field):
+    if not row.has_key(field):
+      return
+    
+    if index.has_key(row[field]):
+      duplicates.append(row[field])
+    else:
+      index[row[field]] = row['id']
+  
+  def parse_row(self, row_el):
+    new_row = Table.parse_row(self, row_el)
+    self.__index(self.by_pid, self.duplicate_pids, new_row, 'pid')
+    self.__index(self.by_rid, self.duplicate_rids, new_row, 'rid')
+    return new_row
+
   @classmethod
-  def __check_commitment(cls, commitment_str, partition_id, instance_id, row_id, external_id, permutation, salt, constant):
+  def __commitment_message(cls, partition_id, instance_id, row_id, external_id, permutation):
     """
-    check the reveal of a commitment to a permutation,
+    prepare the string that we are committing to,
     the "external_id" is the reference to the other table, either pid or rid
     """
-    # prepare the string that we are committing to
     message = chr(partition_id) + chr(instance_id) + str(row_id) + str(external_id)
-    message += ''.join([chr(el) for el in permutation])
+    return message + ''.join([chr(el) for el in permutation])
+  
+  def cl_opening(self, partition_id, instance_id, reveal_row):
+    """
+    the (message, salt, commitment) opening of cl, as commitment.verify_many expects it
+    """
+    relevant_row = self.rows[reveal_row['id']]
+    return (self.__commitment_message(partition_id, instance_id, relevant_row['id'], reveal_row['pid'], reveal_row['d2']), reveal_row['sl'], relevant_row['cl'])
 
-    # reperform commitment and check equality
-    return commitment_str == commitment.commit(message, salt, constant)
+  def cr_opening(self, partition_id, instance_id, reveal_row):
+    relevant_row = self.rows[reveal_row['id']]
+    return (self.__commitment_message(partition_id, instance_id, relevant_row['id'], reveal_row['rid'], reveal_row['d4']), reveal_row['sr'], relevant_row['cr'])
+    
+  def full_row_openings(self, *args):
+    return [self.cl_opening(*args), self.cr_opening(*args)]
   
   def check_cl(self, partition_id, instance_id, reveal_row, constant):
-    relevant_row = self.rows[reveal_row['id']]
-    return self.__check_commitment(relevant_row['cl'], partition_id, instance_id, relevant_row['id'], reveal_row['pid'], reveal_row['d2'], reveal_row['sl'], constant)
+    return commitment.verify_many([self.cl_opening(partition_id, instance_id, reveal_row)], constant)[0]
 
   def check_cr(self, partition_id, instance_id, reveal_row, constant):
-    relevant_row = self.rows[reveal_row['id']]
-    return self.__check_commitment(relevant_row['cr'], partition_id, instance_id, relevant_row['id'], reveal_row['rid'], reveal_row['d4'], reveal_row['sr'], constant)
+    return commitment.verify_many([self.cr_opening(partition_id, instance_id, reveal_row)], constant)[0]
     
-  def check_full_row(self, *args):
-    return self.check_cl(*args) and self.check_cr(*args)
+  def check_full_row(self, partition_id, instance_id, reveal_row, constant):
+    return all(commitment.verify_many(self.full_row_openings(partition_id, instance_id, reveal_row), constant))
   
 class RTable(Table):
   PERMUTATION_FIELDS = ['r']
@@ -449,7 +1071,7 @@ class Ballot(object):
     # dictionary of questions, each is a dictionary of symbols
     self.questions = {}
     
-    if etree:
+    if etree is not None:
       self.parse(etree)
   
   def verify_encodings(self, election, p_table):
@@ -459,21 +1081,45 @@ class Ballot(object):
     the need for the election data structure.
     """
     # going for p3, so it's index 2
-    encoded_choices = p_table.get_permutations_by_row_id(self.pid, election.partition_map_choices)[2]
-    
-    # go through the questions in this ballot
-    for q_id, question in self.questions.iteritems():
-      ballot_symbols = question.keys()
-      q_info = election.spec.questions_by_id[q_id]
-      p_table_symbols = encoded_choices[q_info.partition_num][q_info.position_in_partition]
+    encoded_choices = p_table.get_permutations_by_row_id(self.pid, election.partition_plan_choices)[2]
+    return self.encodings_match(election, encoded_choices)
 
-      # go through the symbols and check them:
-      for symbol in ballot_symbols:
-        if not VERIFY_SYMBOLS[q_info.type_answer_choice](ballot_symbols, p_table_symbols, q_info):
-          import pdb;pdb.set_trace()
-          return False
-              
-    return True          
+  def encodings_match(self, election, encoded_choices):
+    """
+    the check of verify_encodings, given the p3 column of this ballot's P table row
+    already split by election.partition_plan_choices, so that it can run without the P table
+    """
+    return not encoding_failures(election, [(self, encoded_choices)])
+
+  def code_openings(self, open_ballot):
+    """
+    this ballot is the commitment, the other ballot is the opening.
+    
+    Returns the list of (message, salt, commitment) openings to check, as
+    commitment.verify_many expects them, together with the list of
+    (question_id, symbol_id, confirmation_code) revealed by the opening.
+    """
+    openings = []
+    
+    # opening of barcode serial number if it's there
+    if hasattr(open_ballot, 'barcodeSerial') and open_ballot.barcodeSerial != None:
+      openings.append((str(self.pid) + " " + open_ballot.barcodeSerial, open_ballot.barcodeSerialSalt, self.barcodeSerialCommitment))
+        
+    # opening of web serial number
+    openings.append((str(self.pid) + " " + open_ballot.webSerial, open_ballot.webSerialSalt, self.webSerialCommitment))
+    
+    # opening of all marked codes
+    codes = []
+    for q_id, q in open_ballot.questions.iteritems():
+      # the symbols for this ballot
+      committed_symbols = self.questions[q_id]
+      
+      # go through the open symbols
+      for s_id, s in q.iteritems():
+        openings.append((" ".join([str(self.pid), q_id, str(s_id), s['code']]), s['salt'], committed_symbols[s_id]['c']))
+        codes.append((q_id, s_id, s['code']))
+    
+    return openings, codes
     
   def verify_code_openings(self, open_ballot, constant, code_callback_func = None):
     """
@@ -482,7 +1128,7 @@ class Ballot(object):
     The code_callback_func, if present, is a function to call back:
     code_callback_func(web_serial_num, pid, question_id, symbol_id, confirmation_code)
     
-    This is called only when a code is successfully verified, and enables bookkeeping of
+    This is called only when the codes are successfully verified, and enables bookkeeping of
     codes to show the voters in a verification interface.
     """
     
@@ -490,28 +1136,15 @@ class Ballot(object):
     if self.pid != open_ballot.pid:
       return False
     
-    # check opening of barcode serial number if it's there
-    if hasattr(open_ballot, 'barcodeSerial') and open_ballot.barcodeSerial != None:
-      if self.barcodeSerialCommitment != commitment.commit(str(self.pid) + " " + open_ballot.barcodeSerial, open_ballot.barcodeSerialSalt, constant):
-        return false
-        
-    # check opening of web serial number
-    if self.webSerialCommitment != commitment.commit(str(self.pid) + " " + open_ballot.webSerial, open_ballot.webSerialSalt, constant):
+    # all the commitments are checked in one batch
+    openings, codes = self.code_openings(open_ballot)
+    if not all(commitment.verify_many(openings, constant)):
       return False
-    
-    # check opening of all marked codes
-    for q_id, q in open_ballot.questions.iteritems():
-      # the symbols for this ballot
-      committed_symbols = self.questions[q_id]
-      
-      # go through the open symbols
-      for s_id, s in q.iteritems():
-        if committed_symbols[s_id]['c'] != commitment.commit(" ".join([str(self.pid), q_id, str(s_id), s['code']]), s['salt'], constant):
-          return False
           
-        # record the code for this ballot
-        if code_callback_func:
-          code_callback_func(open_ballot.webSerial, self.pid, q_id, s_id, s['code'])          
+    # record the codes for this ballot
+    if code_callback_func:
+      for q_id, s_id, code in codes:
+        code_callback_func(open_ballot.webSerial, self.pid, q_id, s_id, code)
   
     # only if all tests pass, then succeed
     return True
@@ -583,9 +1216,185 @@ def parse_database(etree):
       
   return p_table, partitions
 
-def parse_ballot_table(etree):
+def parse_ballot_table(etree, path='database/printCommitments/ballot'):
   # the ballots
-  ballot_elements = etree.findall('database/printCommitments/ballot')
+  ballot_elements = etree.findall(path)
   
   return dict([(b.pid, b) for b in [Ballot(e) for e in ballot_elements]])
+
+##
+## the same, one row at a time from a stream of parsing events
+##
+
+class StreamedTables(object):
+  """
+  The P, D and R tables and the ballots of one XML file, built from a stream of
+  ('start', 'end') events (see base.iterparse_file_in_dir) one row or ballot at a time.
+  Each row or ballot element is dropped from the tree once it is parsed, so the
+  whole document is never in memory.
+  
+  The tables are then looked up by the same paths the parse_* functions above use.
+  """
+  
+  def __init__(self):
+    # P tables by path
+    self.__p_tables = {}
+    
+    # D tables by path of the partitions, then partition ID, then instance ID
+    self.__d_tables = {}
+    
+    # R tables by path of the partitions, then partition ID
+    self.__r_tables = {}
+    
+    # ballots by path, then pid
+    self.__ballots = {}
+    
+  def p_table(self, path='database/print'):
+    return self.__p_tables[path]
+  
+  def d_tables(self, path='database/partition'):
+    return self.__d_tables.get(path, {})
+  
+  def r_tables(self, path='database/partition'):
+    return self.__r_tables.get(path, {})
+  
+  def ballot_table(self, path='database/printCommitments/ballot'):
+    return self.__ballots.get(path, {})
+    
+  def database(self):
+    """
+    the P table and D tables, as parse_database returns them
+    """
+    return self.p_table(), self.d_tables()
+    
+  def __start(self, path, stack):
+    """
+    a new element opens, the last one on the stack. Returns the table its rows go in, if any
+    """
+    element = stack[-1]
+    
+    if element.tag == 'print':
+      self.__p_tables[path] = table = PTable()
+    elif element.tag == 'partition':
+      self.__d_tables.setdefault(path, {})[int(element.attrib['id'])] = {}
+      return None
+    elif element.tag == 'instance' and path.endswith('partition/decrypt/instance'):
+      partition_path = path[:-len('/decrypt/instance')]
+      partition_id = int(stack[-3].attrib['id'])
+      self.__d_tables[partition_path][partition_id][int(element.attrib['id'])] = table = DTable()
+    elif element.tag == 'results' and path.endswith('partition/results'):
+      partition_path = path[:-len('/results')]
+      partition_id = int(stack[-2].attrib['id'])
+      self.__r_tables.setdefault(partition_path, {})[partition_id] = table = RTable()
+    else:
+      return None
+      
+    if element.attrib.has_key('id'):
+      table.id = int(element.attrib['id'])
+    return table
+    
+  def parse(self, events):
+    # the open elements, their paths below the root, and the tables their rows go in
+    stack = []
+    paths = []
+    tables = []
+    
+    for event, element in events:
+      if event == 'start':
+        stack.append(element)
+        if len(stack) == 1:
+          # the root itself is not part of the paths
+          paths.append('')
+          tables.append(None)
+        else:
+          path = (paths[-1] + '/' + element.tag).lstrip('/')
+          paths.append(path)
+          tables.append(self.__start(path, stack))
+        continue
+        
+      stack.pop()
+      paths.pop()
+      tables.pop()
+      
+      if element.tag == 'row' and tables and tables[-1] is not None:
+        tables[-1].parse_row(element)
+      elif element.tag == 'ballot' and paths:
+        ballot = Ballot(element)
+        self.__ballots.setdefault((paths[-1] + '/ballot').lstrip('/'), {})[ballot.pid] = ballot
+      else:
+        continue
+      
+      # done with this element, drop it from the tree
+      stack[-1].remove(element)
+        
+    return self
+
+def parse_stream(events):
+  return StreamedTables().parse(events)
+
+def stream_r_rows(events, path='database/partition'):
+  """
+  the (partition ID, attributes) of each row of the R tables, from a stream of ('start', 'end')
+  events (see base.iterparse_file_in_dir), as they come. Nothing is kept: every row element,
+  of the R tables or not, is dropped from the tree as soon as it is read.
+  """
+  partition_tags = path.split('/')
+
+  # the open elements, and the partition of the R table we're in, if any
+  stack = []
+  partition_id = None
+
+  for event, element in events:
+    if event == 'start':
+      stack.append(element)
+      if element.tag == 'results' and [el.tag for el in stack[1:-1]] == partition_tags:
+        partition_id = int(stack[-2].attrib['id'])
+      continue
+
+    stack.pop()
+    if element.tag == 'results':
+      partition_id = None
+    elif element.tag == 'row' and stack:
+      if partition_id is not None and stack[-1].tag == 'results':
+        yield partition_id, element.attrib
+      stack[-1].remove(element)
+
+def load_tables(dir, file, filename):
+  """
+  the tables of an XML file, streamed, or from the cache if the file hasn't changed
+  """
+  if base.COMPACT_TABLES:
+    kind = 'compact-tables'
+  else:
+    kind = 'tables'
+  
+  return base.load_in_dir(dir, [(file, filename)],
+                          lambda: parse_stream(base.iterparse_file_in_dir(dir, file, filename)),
+                          kind)
+
+def load_election_params(dir):
+  """
+  the partition info, election spec and election of a data directory.
+  The three depend on each other, so they are cached together
+  """
+  def parse():
+    partition_xml = base.file_in_dir(dir, filenames.PARTITIONS, 'Partition File')
+    election_xml = base.file_in_dir(dir, filenames.ELECTION_SPEC, 'Election Spec')
+    meeting_one_in_xml = base.file_in_dir(dir, filenames.MEETING_ONE_IN, 'Meeting One In')
+    
+    partition_info = PartitionInfo()
+    partition_info.parse(partition_xml)
+    
+    election_spec = ElectionSpec(partition_info)
+    election_spec.parse(election_xml)
+    
+    election = Election(election_spec)
+    election.parse(meeting_one_in_xml)
+    
+    return partition_info, election_spec, election
+  
+  return base.load_in_dir(dir, [(filenames.PARTITIONS, 'Partition File'),
+                                (filenames.ELECTION_SPEC, 'Election Spec'),
+                                (filenames.MEETING_ONE_IN, 'Meeting One In')],
+                          parse, 'election')
   
@@ -27,30 +27,17 @@ def set_meeting_two_random_data(relative_filename):
   MEETING_TWO_RANDOM_DATA = relative_filename
 
 # third meeting
-MEETING_THREE_IN = "MeetingThreeIn.xml"
-MEETING_THREE_OUT = "MeetingThreeOut.xml"
-MEETING_THREE_OUT_CODES = "MeetingThreeOutCodes.xml"
+MEETING_THREE_FILES = ("MeetingThreeIn.xml", "MeetingThreeOut.xml", "MeetingThreeOutCodes.xml")
+MEETING_THREE_IN, MEETING_THREE_OUT, MEETING_THREE_OUT_CODES = MEETING_THREE_FILES
 
-def go_provisional():
-  # oh I feel dirty, but this is what happens when a new piece of the process is introduced without warning
-  global MEETING_THREE_IN
-  global MEETING_THREE_OUT
-  global MEETING_THREE_OUT_CODES
-  
-  # third meeting with provisional ballots
-  MEETING_THREE_IN = "MeetingThreeIn-Provisional-Manual.xml"
-  MEETING_THREE_OUT = "MeetingThreeOut-Provisional-Manual.xml"
-  MEETING_THREE_OUT_CODES = "MeetingThreeOutCodes-Provisional-Manual.xml"
-  
-def reset():
-  # oh I feel dirty, but this is what happens when a new piece of the process is introduced without warning
-  global MEETING_THREE_IN
-  global MEETING_THREE_OUT
-  global MEETING_THREE_OUT_CODES
+# third meeting with provisional ballots
+MEETING_THREE_FILES_PROVISIONAL = ("MeetingThreeIn-Provisional-Manual.xml", "MeetingThreeOut-Provisional-Manual.xml", "MeetingThreeOutCodes-Provisional-Manual.xml")
 
-  MEETING_THREE_IN = "MeetingThreeIn.xml"
-  MEETING_THREE_OUT = "MeetingThreeOut.xml"
-  MEETING_THREE_OUT_CODES = "MeetingThreeOutCodes.xml"
+def meeting_three_files(provisional=False):
+  "The meeting 3 in, out and codes files, with provisional ballots or not"
+  if provisional:
+    return MEETING_THREE_FILES_PROVISIONAL
+  return MEETING_THREE_FILES
 
 # fourth meeting
 MEETING_FOUR_IN = "MeetingFourIn.xml"
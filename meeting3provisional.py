@@ -4,25 +4,36 @@ Run Meeting 3 with Provisional Ballots Added
 2009-11-05
 
 Usage:
-python meeting3-provisional.py <DATA_PATH> [<CODES_FILE_PATH>]
+python meeting3-provisional.py <DATA_PATH> [<CODES_FILE_PATH>] [--codes-index <INDEX_FILE>] [--delta]
 
 data path should NOT have a trailing slash
 
 CODES_FILE_PATH is the path to a file which, when provided, will be where
 this script writes its list of confirmation codes for each ballot.
+
+INDEX_FILE, when provided, is where the same codes are also written as an index
+by web serial number, for looking up the codes of a ballot with codes.py
+
+With --delta, the ballots are matched by pid to those of the regular meeting 3 files,
+and the audit fails if one of them isn't the same, or doesn't have the same P table row,
+with the provisional ballots. Only the other ballots, the ones added, are checked:
+the regular ones are left to meeting3.py, which must verify too. The report says so.
 """
 
-import filenames
-filenames.go_provisional()
+import sys
+import base, audit
+
+context = audit.AuditContext(base.DATA_PATH, provisional=True)
 
-from meeting3 import *
+def verify(output_stream, codes_output_stream=None, codes_index_path=None):
+  audit.meeting_three_provisional(context, output_stream, codes_output_stream, codes_index_path)
 
 if __name__ == '__main__':
   if len(sys.argv) > 2:
     codes_output = open(sys.argv[2], "w")
   else:
     codes_output = None
-  verify(sys.stdout, codes_output)
+  verify(sys.stdout, codes_output, base.CODES_INDEX)
   
   if codes_output:
     codes_output.close()
@@ -14,10 +14,7 @@ More than one data path because we are tallying up multiple wards at the same ti
 The reason for specifying the question_num is that some questions are split among multiple wards, others not.
 """
 
-import filenames
-filenames.go_provisional()
-
-from tally import *
+import tally
 
 if __name__ == '__main__':
-  tally(sys.stdout)
\ No newline at end of file
+  tally.main(provisional=True)
@@ -2,7 +2,9 @@
 The tallying of the R tables, no verification otherwise
 
 Usage:
-python tally.py <QUESTION_ID> <DATA_PATH> <DATA_PATH_2> <DATA_PATH_3> ... 
+python tally.py <QUESTION_ID> <DATA_PATH> <DATA_PATH_2> <DATA_PATH_3> ...
+python tally.py <QUESTION_ID>,<QUESTION_ID>,... <DATA_PATH> ... [--per-ward <QUESTION_ID>,...]
+python tally.py all <DATA_PATH> ... [--per-ward <QUESTION_ID>,...]
 
 QUESTION_ID is the question_id from electionspec.xml
 data paths should NOT have a trailing slash
@@ -11,67 +13,454 @@ More than one data path because we are tallying up multiple wards at the same ti
 
 The reason for specifying the question_num is that some questions are split among multiple wards, others not.
 
+Several questions, or all of them, are tallied in one pass over the R tables, with one report.
+Each question is tallied over all the data paths together, except those given with --per-ward,
+which are tallied in each data path separately, e.g. for Takoma Park:
+
+python tally.py all ward1 ward2 ward3 ward4 ward5 ward6 --per-ward 1
+
+Each data path is tallied on its own, then the tallies are merged, so with --workers N
+the data paths are tallied in N processes. The tally of one data path can also be written
+to a file, its partial tally, to be merged with the others later, e.g. on another machine:
+
+python tally.py all ward1 --partial ward1-tally.xml
+...
+python tally.py all --merge ward1-tally.xml ward2-tally.xml ... --per-ward 1
+
+The report is the same as that of the data paths tallied together, followed by the
+fingerprints of the files each partial tally comes from.
+
+With --stream, the rows of the R tables are counted as they are read off the file,
+a few at a time, rather than loaded as tables first, for large data paths.
+
+With --cache-dir DIR, the tally of each question in each data path is kept in DIR and
+used again until one of its files changes. The report says which tallies were cached
+and which were recomputed. --tally-cache-size N bounds the bytes of tallies kept.
 """
 
 # core imports
-import sys
-import base, data, filenames
+import sys, os, hashlib
+from xml.etree import ElementTree
+import base, audit, data, batch
 
 import tallydata
 
-# correcting the argv base.DATA_PATH
-QUESTION_ID = sys.argv[1]
-DATA_PATHS = sys.argv[2:]  
-
-# for default election params
-base.DATA_PATH = DATA_PATHS[0]
-
-# use the meeting1 data structures
-from electionparams import *
-
-# import just the R tables
-# there could be a few given the multiple data_paths
-r_tables_xml = [base.file_in_dir(data_path, filenames.MEETING_THREE_OUT, 'Meeting Three Out') for data_path in DATA_PATHS]
-r_tables_list = [data.parse_r_tables(r_tables) for r_tables in r_tables_xml]
-
-# print "ok now tallying\n\n"
-
-# the list of partitions, each of which is a list of the max number of answers each question allows
-partition_map = election.partition_map_choices
-
-# we only tally per question now, so BALLOTS is just an array
-BALLOTS = []
-  
-# go through each partition
-for r_tables in r_tables_list:
-  for p_id, r_table in r_tables.iteritems():
-    for row_id, row in r_table.rows.iteritems():
-      # split the result among questions for this partition, according to partition map
-      split_result = r_table.get_permutations_by_row_id(row_id, partition_map[p_id])
-    
-      # go through the questions
-      for q_num, question in enumerate(election.spec.questions_by_partition[p_id]):
-        # skip over the questions we're not counting
-        if question.id != QUESTION_ID:
-          continue
-        
-        # index 0 because there is only one permutation field in this table,
-        # but it's returned as a list, so we select the first and only one,
-        # then select the specific question number
-        raw_answer = split_result[0][q_num]
-      
-        # instantiate the right ballot type
-        ballot = tallydata.BALLOTS_BY_TYPE[question.type_answer_choice](raw_answer)
-      
-        BALLOTS.append(ballot)
-
-# now tally, only one tally
-TALLY = BALLOTS[0].tally(election.spec.questions_by_id[QUESTION_ID], BALLOTS)
-
-RESULT = "Question %s: %s\n" % (QUESTION_ID, TALLY)
-
-def tally(output_stream):
-  
+##
+## the tally of one data directory
+##
+
+class PartialTally(object):
+  """
+  The tallies of some questions in the R tables of one data directory, before they are
+  merged with those of the other directories, e.g. the other wards. For each question,
+  the tallydata partial tally of its ballots, which is a few counts however many ballots there are.
+
+  It keeps the fingerprints of the files it comes from, and is written out as a small XML file.
+  """
+  def __init__(self, election_id, data_path, provisional, fingerprints):
+    self.election_id = election_id
+    self.data_path = data_path
+    self.provisional = provisional
+    self.fingerprints = fingerprints
+
+    # in the order they were added, by question id, (type_answer_choice, number of answers, partial tally)
+    self.question_ids = []
+    self.questions = {}
+
+    # the questions whose tallies were taken from the cache, rather than recomputed
+    self.cached_question_ids = []
+
+  def add(self, question_id, type_answer_choice, num_answers, partial):
+    self.question_ids.append(question_id)
+    self.questions[question_id] = (type_answer_choice, num_answers, partial)
+
+  def write(self, stream):
+    root = ElementTree.Element('partial_tally', {'election': self.election_id, 'data_path': self.data_path,
+                                                 'provisional': str(self.provisional).lower()})
+    root.text = "\n"
+    for label, fingerprint in self.fingerprints:
+      ElementTree.SubElement(root, 'file', {'name': label, 'fingerprint': fingerprint}).tail = "\n"
+
+    for question_id in self.question_ids:
+      type_answer_choice, num_answers, partial = self.questions[question_id]
+      question = ElementTree.SubElement(root, 'question', {'id': question_id, 'type': type_answer_choice,
+                                                           'answers': str(num_answers), 'ballots': str(partial.num_ballots)})
+      question.text = question.tail = "\n"
+      for choices, count in partial.entries():
+        entry = ElementTree.SubElement(question, 'choices', {'count': str(count)})
+        entry.text = " ".join(["%d" % choice for choice in choices])
+        entry.tail = "\n"
+
+    ElementTree.ElementTree(root).write(stream)
+    stream.write("\n")
+
+  @classmethod
+  def from_etree(cls, etree):
+    try:
+      partial_tally = cls(etree.attrib['election'], etree.attrib['data_path'], etree.attrib['provisional'] == 'true',
+                          [[f.attrib['name'], f.attrib['fingerprint']] for f in etree.findall('file')])
+    except KeyError, e:
+      raise ValueError("it doesn't have the %s of the tally or of a file" % e)
+
+    for question in etree.findall('question'):
+      question_id = question.attrib.get('id')
+      type_answer_choice = question.attrib.get('type')
+      if question_id is None:
+        raise ValueError("a question doesn't have an id")
+      if not tallydata.PARTIALS_BY_TYPE.has_key(type_answer_choice):
+        raise ValueError("question %s is of unknown type %s" % (question_id, type_answer_choice))
+
+      try:
+        num_answers = int(question.attrib['answers'])
+        num_ballots = int(question.attrib['ballots'])
+        # an empty element is a ranking with no choices
+        entries = [(tuple([int(choice) for choice in (entry.text or "").split()]), int(entry.attrib['count']))
+                   for entry in question.findall('choices')]
+      except (KeyError, ValueError):
+        raise ValueError("question %s doesn't have a number of answers and of ballots, and a count of each choice" % question_id)
+      if num_answers <= 0:
+        raise ValueError("question %s has %s answers" % (question_id, num_answers))
+
+      partial = tallydata.PARTIALS_BY_TYPE[type_answer_choice].from_entries(entries, num_ballots)
+      partial_tally.add(question_id, type_answer_choice, num_answers, partial)
+
+    return partial_tally
+
+def load_partial_tally(path):
+  """
+  a partial tally written out by PartialTally.write, fingerprinted like the election files.
+  A ValueError says what is wrong with it.
+  """
+  etree = base.file_in_dir(os.path.dirname(path) or '.', os.path.basename(path), path)
+  try:
+    return PartialTally.from_etree(etree)
+  except ValueError, e:
+    raise ValueError("%s is not a partial tally: %s" % (path, e))
+
+# how many rows of a partition are read off the file before they are counted, with --stream
+STREAM_ROWS = 10000
+
+def _add_rows(plan, counted, rows):
+  """
+  add the r field of each row, split by plan, to the partial tallies of the (q_num, partial) counted
+  """
+  for r in rows:
+    # split the result among questions for this partition, according to partition map,
+    # there is only one permutation field in this table
+    split_result = plan.split(r)
+
+    for q_num, partial in counted:
+      partial.add(split_result[q_num])
+
+def _add_array(plan, counted, choices):
+  """
+  the same for the r fields of all the rows at once, as a 2-D array
+  """
+  choices = plan.split_column(choices)
+  for q_num, partial in counted:
+    partial.add_column(choices[q_num])
+
+def _add_fields(plan, counted, fields):
+  """
+  the same for the r fields of the rows as they are in the file
+  """
+  try:
+    choices = batch.stack_fields(fields)
+  except ValueError:
+    # some rows don't fit in an array, one row at a time then
+    _add_rows(plan, counted, [data.decode_permutation(field) for field in fields])
+  else:
+    _add_array(plan, counted, choices)
+
+def ward_tally(context, question_ids, stream=False):
+  """
+  the PartialTally of the questions in the R tables of one context, in one pass over them.
+
+  With stream, the rows are read off the file a few at a time as they are counted,
+  rather than loaded as tables first, so that however many ballots there are,
+  only STREAM_ROWS rows of a partition are in memory at once.
+  """
+  election = context.election
+
+  # the list of partitions, each of which is a list of the max number of answers each question allows,
+  # worked out once as a plan for splitting the rows
+  partition_plan = election.partition_plan_choices
+
+  questions = [election.spec.questions_by_id[question_id] for question_id in question_ids]
+  partials = dict([(question.id, tallydata.PARTIALS_BY_TYPE[question.type_answer_choice]()) for question in questions])
+
+  # the questions of each partition we're counting
+  counted = [[(q_num, partials[question.id]) for q_num, question in enumerate(partition_questions)
+              if partials.has_key(question.id)]
+             for partition_questions in election.spec.questions_by_partition]
+
+  if stream:
+    # the rows of each partition read but not counted yet
+    pending = {}
+    for p_id, row in context.r_rows():
+      if not counted[p_id]:
+        continue
+
+      fields = pending.setdefault(p_id, [])
+      fields.append(row['r'])
+      if len(fields) >= STREAM_ROWS:
+        _add_fields(partition_plan.parts[p_id], counted[p_id], fields)
+        pending[p_id] = []
+
+    for p_id, fields in pending.iteritems():
+      _add_fields(partition_plan.parts[p_id], counted[p_id], fields)
+
+  else:
+    # go through each partition
+    for p_id, r_table in context.r_tables.iteritems():
+      if not counted[p_id]:
+        continue
+
+      # the choices of all the rows at once, as an array
+      try:
+        choices = r_table.permutation_array('r')
+      except ValueError:
+        # some rows don't fit in an array, one row at a time then
+        _add_rows(partition_plan.parts[p_id], counted[p_id], (row['r'] for row in r_table.rows.itervalues()))
+      else:
+        _add_array(partition_plan.parts[p_id], counted[p_id], choices)
+
+  partial_tally = PartialTally(election.spec.id, context.data_path, context.provisional, context.all_fingerprints())
+  for question in questions:
+    partial_tally.add(question.id, question.type_answer_choice, len(question.answers), partials[question.id])
+  return partial_tally
+
+##
+## a cache of the tallies, with --cache-dir
+##
+## The tally of each question in each data directory is kept there as a partial tally file,
+## under the question, the provisional ballots or not, and the fingerprints of the files
+## the tally comes from, which are computed afresh on every run. A tally is used again as long
+## as none of its files change. The entries used least recently go first once they take up
+## more than TALLY_CACHE_SIZE bytes.
+##
+
+# the files a tally comes from
+TALLY_FILES = audit.ELECTION_FILES + ['MEETING_THREE_OUT']
+
+# how many bytes of tallies are kept in the cache, given as --tally-cache-size N
+TALLY_CACHE_SIZE = 10 * 1024 * 1024
+
+def _tally_cache_path(question_id, provisional, fingerprints):
+  key = hashlib.sha1(repr((question_id, provisional, [fingerprint for label, fingerprint in fingerprints]))).hexdigest()
+  return os.path.join(base.CACHE_DIR, 'tally-%d-%s.xml' % (base.CACHE_VERSION, key))
+
+def _load_cached_tally(path, question_id):
+  """
+  the (type_answer_choice, number of answers, partial tally) of the question in a cache entry, None if it isn't there
+  """
+  if not os.path.exists(path):
+    return None
+  try:
+    f = open(path, 'r')
+    try:
+      entry = PartialTally.from_etree(ElementTree.parse(f).getroot())
+    finally:
+      f.close()
+  except Exception:
+    # a damaged entry, tally again and replace it
+    return None
+
+  if not entry.questions.has_key(question_id):
+    return None
+
+  # it's now the most recently used
+  os.utime(path, None)
+  return entry.questions[question_id]
+
+def _store_cached_tally(path, entry):
+  if not os.path.isdir(base.CACHE_DIR):
+    os.makedirs(base.CACHE_DIR)
+
+  # written under a temporary name, so a concurrent run never sees half an entry
+  temp_path = '%s.%d.tmp' % (path, os.getpid())
+  f = open(temp_path, 'w')
+  try:
+    entry.write(f)
+  finally:
+    f.close()
+  os.rename(temp_path, path)
+
+def _evict_cached_tallies():
+  """
+  remove the entries used least recently until they take up no more than TALLY_CACHE_SIZE bytes
+  """
+  entries = []
+  for name in os.listdir(base.CACHE_DIR):
+    if not (name.startswith('tally-') and name.endswith('.xml')):
+      continue
+    path = os.path.join(base.CACHE_DIR, name)
+    try:
+      stat = os.stat(path)
+    except OSError:
+      # removed by another run in the meantime
+      continue
+    entries.append((stat.st_mtime, path, stat.st_size))
+
+  entries.sort()
+  total_size = sum([size for mtime, path, size in entries])
+  for mtime, path, size in entries:
+    if total_size <= TALLY_CACHE_SIZE:
+      break
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+    total_size -= size
+
+def cached_ward_tally(context, question_ids, stream=False):
+  """
+  ward_tally, with a cache directory (base.CACHE_DIR, --cache-dir): the tallies of the questions
+  that are in the cache are taken from there, and only the others are tallied, then put there.
+  The cached_question_ids of the PartialTally says which were which.
+  """
+  if not base.CACHE_DIR:
+    return ward_tally(context, question_ids, stream)
+
+  fingerprints = context.fingerprints(TALLY_FILES)
+
+  found = {}
+  for question_id in question_ids:
+    cached = _load_cached_tally(_tally_cache_path(question_id, context.provisional, fingerprints), question_id)
+    if cached is not None:
+      found[question_id] = cached
+  cached_question_ids = [question_id for question_id in question_ids if found.has_key(question_id)]
+
+  missing = [question_id for question_id in question_ids if not found.has_key(question_id)]
+  if missing:
+    tallied = ward_tally(context, missing, stream)
+
+    # the fingerprints of the files as they were read for the tally, which the context
+    # recorded while parsing them, in case one changed since it was fingerprinted above
+    tallied_fingerprints = context.fingerprints(TALLY_FILES)
+    if tallied_fingerprints != fingerprints and cached_question_ids:
+      # the cached tallies are of the files as they were, so they can't go with the new ones
+      missing, cached_question_ids = question_ids, []
+      tallied = ward_tally(context, missing, stream)
+      tallied_fingerprints = context.fingerprints(TALLY_FILES)
+    fingerprints = tallied_fingerprints
+
+    # a streamed file that wasn't read to the end doesn't have a fingerprint to store the tallies under
+    complete = base.INCOMPLETE_FINGERPRINT not in [fingerprint for label, fingerprint in fingerprints]
+    for question_id in missing:
+      found[question_id] = tallied.questions[question_id]
+      if complete:
+        entry = PartialTally(tallied.election_id, context.data_path, context.provisional, fingerprints)
+        entry.add(question_id, *tallied.questions[question_id])
+        _store_cached_tally(_tally_cache_path(question_id, context.provisional, fingerprints), entry)
+  _evict_cached_tallies()
+
+  partial_tally = PartialTally(context.election.spec.id, context.data_path, context.provisional, fingerprints)
+  for question_id in question_ids:
+    partial_tally.add(question_id, *found[question_id])
+  partial_tally.cached_question_ids = cached_question_ids
+  return partial_tally
+
+def _ward_tally_worker((data_path, provisional, question_ids, stream)):
+  return cached_ward_tally(audit.AuditContext(data_path, provisional), question_ids, stream)
+
+def tally_wards(contexts, question_ids, stream=False, workers=None):
+  """
+  the PartialTally of each context, streamed or not, over workers processes (base.WORKERS by default)
+  """
+  if workers is None:
+    workers = base.WORKERS
+
+  if workers <= 1 or len(contexts) <= 1:
+    return [cached_ward_tally(context, question_ids, stream) for context in contexts]
+
+  return base.parallel_map(_ward_tally_worker, [(context.data_path, context.provisional, question_ids, stream) for context in contexts],
+                           workers, chunksize=1)
+
+##
+## the tally of all of them
+##
+
+def merge_tallies(scopes, ward_tallies):
+  """
+  the tallies of several questions, from the PartialTally of each ward.
+  scopes is a list of (question_id, per_ward): a question per ward is tallied in each
+  ward separately, the others in all of them together.
+
+  Returns, in the order of scopes, then of the wards for a question per ward,
+  (question_id, the data paths tallied, the tallydata partial tally of their ballots, TALLY)
+  """
+  results = []
+  for question_id, per_ward in scopes:
+    wards = []
+    for ward in ward_tallies:
+      if not ward.questions.has_key(question_id):
+        raise ValueError("the tally of %s doesn't have question %s" % (ward.data_path, question_id))
+      wards.append((ward.data_path, ward.questions[question_id]))
+
+    if per_ward:
+      for data_path, (type_answer_choice, num_answers, partial) in wards:
+        results.append((question_id, [data_path], partial, partial.tally(num_answers)))
+      continue
+
+    # the question must be the same everywhere to be tallied over all the wards
+    type_answer_choice, num_answers, partial = wards[0][1]
+    merged = tallydata.PARTIALS_BY_TYPE[type_answer_choice]()
+    for data_path, (ward_type, ward_num_answers, partial) in wards:
+      if (ward_type, ward_num_answers) != (type_answer_choice, num_answers):
+        raise ValueError("question %s is not the same in %s as in %s" % (question_id, data_path, wards[0][0]))
+      merged.update(partial)
+
+    results.append((question_id, [data_path for data_path, question in wards], merged, merged.tally(num_answers)))
+
+  return results
+
+def check_partial_tallies(ward_tallies, provisional=False):
+  """
+  the partial tallies to merge must be of the same election, all with or all without
+  the provisional ballots, each of different files, and with the same questions
+  """
+  sources = {}
+  for ward in ward_tallies:
+    if ward.election_id != ward_tallies[0].election_id:
+      raise ValueError("the tally of %s is of election %s, not %s" % (ward.data_path, ward.election_id, ward_tallies[0].election_id))
+    if ward.provisional != provisional:
+      raise ValueError("the tally of %s is %s the provisional ballots" % (ward.data_path, ward.provisional and "with" or "without"))
+
+    source = tuple([fingerprint for label, fingerprint in ward.fingerprints])
+    if sources.has_key(source):
+      raise ValueError("the tallies of %s and %s are of the same files" % (sources[source], ward.data_path))
+    sources[source] = ward.data_path
+
+    # each question must have the same type and number of answers in all of them
+    for question_id in ward.question_ids:
+      first = ward_tallies[0].questions.get(question_id)
+      if first and ward.questions[question_id][:2] != first[:2]:
+        raise ValueError("question %s is not the same in %s as in %s" % (question_id, ward.data_path, ward_tallies[0].data_path))
+
+def tally_questions(scopes, contexts):
+  """
+  merge_tallies of the contexts, each tallied in one pass over its R tables
+  """
+  question_ids = []
+  for question_id, per_ward in scopes:
+    if question_id not in question_ids:
+      question_ids.append(question_id)
+
+  return merge_tallies(scopes, tally_wards(contexts, question_ids))
+
+##
+## the reports
+##
+
+def report(output_stream, election_id, results):
+  """
+  the report of a single question tallied over all the data paths
+  """
+  [(question_id, data_paths, partial, TALLY)] = results
+
+  RESULT = "Question %s: %s\n" % (question_id, TALLY)
+
   output_stream.write("""Election ID: %s
 Tally
 
@@ -79,7 +468,105 @@ Tally
 
 %s
 
-""" % (election.spec.id, len(BALLOTS), RESULT))
+""" % (election_id, partial.num_ballots, RESULT))
+
+def report_all(output_stream, election_id, results):
+  """
+  the combined report of the tallies of several questions
+  """
+  RESULTS = ""
+  for question_id, data_paths, partial, TALLY in results:
+    RESULTS += "Question %s in %s: %s ballots cast\n" % (question_id, ", ".join(data_paths), partial.num_ballots)
+    RESULTS += "Question %s: %s\n\n" % (question_id, TALLY)
+
+  output_stream.write("""Election ID: %s
+Tally
+
+%s
+""" % (election_id, RESULTS))
+
+def cache_report(ward_tallies):
+  """
+  whether the tally of each question in each data path was cached or recomputed
+  """
+  report = ""
+  for ward in ward_tallies:
+    for question_id in ward.question_ids:
+      if question_id in ward.cached_question_ids:
+        report += "Question %s in %s: cached\n" % (question_id, ward.data_path)
+      else:
+        report += "Question %s in %s: recomputed\n" % (question_id, ward.data_path)
+  return report
+
+def tally(output_stream, question_id, contexts):
+  report(output_stream, contexts[0].election.spec.id, tally_questions([(question_id, False)], contexts))
+
+def main(provisional=False):
+  per_ward = base._pop_option('--per-ward', '')
+  partial_path = base._pop_option('--partial', None)
+  merge = base._pop_flag('--merge')
+  stream = base._pop_flag('--stream')
+
+  global TALLY_CACHE_SIZE
+  TALLY_CACHE_SIZE = base._pop_option('--tally-cache-size', TALLY_CACHE_SIZE, int)
+
+  question_ids = sys.argv[1]
+  paths = sys.argv[2:]
+
+  # the usual tally of one question, with the usual report
+  single = ',' not in question_ids and question_ids != 'all' and not per_ward
+
+  if merge:
+    try:
+      ward_tallies = [load_partial_tally(path) for path in paths]
+      check_partial_tallies(ward_tallies, provisional)
+    except ValueError, e:
+      print e
+      sys.exit(1)
+    election_id = ward_tallies[0].election_id
+    all_question_ids = ward_tallies[0].question_ids
+  else:
+    contexts = [audit.AuditContext(data_path, provisional) for data_path in paths]
+    election_id = contexts[0].election.spec.id
+    all_question_ids = [question.id for question in contexts[0].election.spec.questions]
+
+  if question_ids == 'all':
+    question_ids = all_question_ids
+  else:
+    question_ids = question_ids.split(',')
+
+  if partial_path:
+    if merge or len(contexts) != 1:
+      print "--partial writes the tally of one data path"
+      sys.exit(1)
+    partial_file = open(partial_path, "w")
+    cached_ward_tally(contexts[0], question_ids, stream).write(partial_file)
+    partial_file.close()
+    return
+
+  scopes = [(question_id, question_id in per_ward.split(',')) for question_id in question_ids]
+  if merge:
+    try:
+      results = merge_tallies(scopes, ward_tallies)
+    except ValueError, e:
+      print e
+      sys.exit(1)
+  else:
+    ward_tallies = tally_wards(contexts, question_ids, stream)
+    results = merge_tallies(scopes, ward_tallies)
+
+  if single:
+    report(sys.stdout, election_id, results)
+  else:
+    report_all(sys.stdout, election_id, results)
+
+  if base.CACHE_DIR and not merge:
+    sys.stdout.write("Tally cache\n%s\n" % cache_report(ward_tallies))
+
+  if merge:
+    for ward in ward_tallies:
+      sys.stdout.write("Fingerprints of %s\n%s\n" % (ward.data_path, base.fingerprint_report(ward.fingerprints)))
+    sys.stdout.write("Fingerprints of the partial tallies\n%s" % base.fingerprint_report())
 
 if __name__ == '__main__':
-  tally(sys.stdout)
\ No newline at end of file
+  main()
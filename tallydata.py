@@ -6,6 +6,8 @@ ben@adida.net
 2009-10-31
 """
 
+import batch
+
 BALLOTS_BY_TYPE = {}
 
 class RankBallot(object):
@@ -53,43 +55,111 @@ class RankBallot(object):
   @classmethod
   def tally(cls, question, ballots):
     """
-    tally a bunch of ranked ballots.
-    Could be easily improved for efficiency, but went for obviously correct code first.
-    Plus, this is pretty quick anyways
+    tally a bunch of ranked ballots, by way of the RankPatterns they come to
+    """
+    patterns = RankPatterns()
+    for b in ballots:
+      patterns.add(b.choices)
+    return patterns.tally(len(question.answers))
+
+class RankPatterns(object):
+  """
+  Ranked ballots collapsed into the number of ballots with each ranking.
+  Ballots with the same ranking move from one candidate to the next together,
+  so the tally works on one RankBallot per distinct ranking, whatever the number of ballots.
+  """
+  def __init__(self):
+    self.counts = {}
+
+  def add(self, choices, count=1):
+    pattern = tuple(choices)
+    self.counts[pattern] = self.counts.get(pattern, 0) + count
+
+  def add_column(self, choices):
+    """
+    add the ballots of a 2-D array of choices, a row per ballot, as batch makes them
+    """
+    for row in batch.to_lists(choices):
+      self.add(row)
+
+  def update(self, other):
+    """
+    add the ballots of other RankPatterns, e.g. those of another ward
+    """
+    for pattern, count in other.counts.iteritems():
+      self.add(pattern, count)
+
+  @property
+  def num_ballots(self):
+    return sum(self.counts.values())
+
+  def entries(self):
+    """
+    the (ranking, number of ballots) of each distinct ranking, in order
+    """
+    return sorted(self.counts.items())
+
+  @classmethod
+  def from_entries(cls, entries, num_ballots):
+    """
+    the RankPatterns of the entries, as given by entries()
+    """
+    patterns = cls()
+    for pattern, count in entries:
+      patterns.add(pattern, count)
+    if patterns.num_ballots != num_ballots:
+      raise ValueError("the rankings come to %s ballots, not %s" % (patterns.num_ballots, num_ballots))
+    return patterns
+
+  def tally(self, num_answers):
+    """
+    the instant runoff: the same rounds as counting the ballots one by one,
+    but only the rankings on the candidate just eliminated move to their next choice.
+    Returns the candidate tallies of the last round, None for the eliminated candidates.
     """
     # if we round to the half, we increment by 1
-    absolute_majority = len(ballots) / 2 + len(ballots)%2 + 1
-    
+    num_ballots = self.num_ballots
+    absolute_majority = num_ballots / 2 + num_ballots%2 + 1
+
+    # the rankings, and the number of ballots, on each candidate
+    groups_by_choice = {}
+    counts_by_choice = {}
+    def place(ballot, count):
+      if not ballot.exhausted:
+        groups_by_choice.setdefault(ballot.current_choice, []).append((ballot, count))
+        counts_by_choice[ballot.current_choice] = counts_by_choice.get(ballot.current_choice, 0) + count
+
+    for pattern in sorted(self.counts.keys()):
+      place(RankBallot(list(pattern)), self.counts[pattern])
+
     eliminated = []
     # eliminate and redistribute until done
     while True:
-      candidate_tallies = [0] * len(question.answers)
+      candidate_tallies = [0] * num_answers
       for i in eliminated:
         candidate_tallies[i] = None
 
-      try:
-        # count
-        for b in ballots:
-          if not b.exhausted:
-            candidate_tallies[b.current_choice] += 1
-      except Exception, e:
-        import pdb; pdb.set_trace()
-        bad_ballot = b
-        print "oy"
-      
-      # print candidate_tallies
+      # count
+      for choice, count in counts_by_choice.iteritems():
+        if choice >= len(candidate_tallies) or candidate_tallies[choice] is None:
+          raise ValueError("ballots ranked %s go on to candidate %s, who isn't in the running" %
+                           (groups_by_choice[choice][0][0].choices, choice))
+        candidate_tallies[choice] += count
 
       if max(candidate_tallies) >= absolute_majority:
         break
-        
+
       # eliminate
       lowest_count = min([tally for tally in candidate_tallies if tally is not None])
       lowest_count_index = candidate_tallies.index(lowest_count)
       eliminated.append(lowest_count_index)
-      # print "eliminating candidate %s with count %s" % (lowest_count_index, lowest_count)
-      for b in ballots:
-        b.go_next_choice(lowest_count_index)
-    
+
+      # only the rankings that were on that candidate move
+      counts_by_choice.pop(lowest_count_index, None)
+      for ballot, count in groups_by_choice.pop(lowest_count_index, []):
+        ballot.go_next_choice(lowest_count_index)
+        place(ballot, count)
+
     return candidate_tallies
 
 class SimpleBallot(object):
@@ -102,15 +172,77 @@ class SimpleBallot(object):
     """
     tally a bunch of ballots where choices are just single or multi candidate.
     """
-    candidate_tallies = [0] * len(question.answers)
-    
+    counts = SimpleCounts()
     for b in ballots:
-      for option in b.choices:
-        candidate_tallies[option] += 1
-    
+      counts.add(b.choices)
+    return counts.tally(len(question.answers))
+
+class SimpleCounts(object):
+  """
+  Single or multi candidate ballots collapsed into the number of times each choice comes up,
+  which is all their tally needs. A -1 is no choice, and isn't counted.
+  """
+  def __init__(self):
+    self.counts = {}
+    self.num_ballots = 0
+
+  def add(self, choices, count=1):
+    for option in choices:
+      if option != -1:
+        self.counts[option] = self.counts.get(option, 0) + count
+    self.num_ballots += count
+
+  def add_column(self, choices):
+    """
+    add the ballots of a 2-D array of choices, a row per ballot, as batch makes them,
+    counting all the choices at once
+    """
+    for option, count in batch.count_values(choices).iteritems():
+      if option != -1:
+        self.counts[option] = self.counts.get(option, 0) + count
+    self.num_ballots += len(choices)
+
+  def update(self, other):
+    for option, count in other.counts.iteritems():
+      self.counts[option] = self.counts.get(option, 0) + count
+    self.num_ballots += other.num_ballots
+
+  def entries(self):
+    """
+    the ((choice,), number of times it comes up) of each choice, in order
+    """
+    return sorted([((option,), count) for option, count in self.counts.iteritems()])
+
+  @classmethod
+  def from_entries(cls, entries, num_ballots):
+    """
+    the SimpleCounts of num_ballots ballots, with the entries given by entries()
+    """
+    counts = cls()
+    for (option,), count in entries:
+      if option != -1:
+        counts.counts[option] = counts.counts.get(option, 0) + count
+    counts.num_ballots = num_ballots
+    return counts
+
+  def tally(self, num_answers):
+    candidate_tallies = [0] * num_answers
+
+    for option, count in self.counts.iteritems():
+      if option < 0 or option >= num_answers:
+        raise ValueError("%s ballots have choice %s, which isn't a candidate" % (count, option))
+      candidate_tallies[option] += count
+
     return candidate_tallies
-  
-      
+
 BALLOTS_BY_TYPE['rank'] = RankBallot
 BALLOTS_BY_TYPE['one_answer'] = SimpleBallot
-BALLOTS_BY_TYPE['multiple_answers'] = SimpleBallot
\ No newline at end of file
+BALLOTS_BY_TYPE['multiple_answers'] = SimpleBallot
+
+# what the ballots of each type of question are collapsed into,
+# each with add(choices, count), add_column(choices), update(other), num_ballots, tally(num_answers),
+# and entries() and from_entries(entries, num_ballots) to write them out and read them back
+PARTIALS_BY_TYPE = {}
+PARTIALS_BY_TYPE['rank'] = RankPatterns
+PARTIALS_BY_TYPE['one_answer'] = SimpleCounts
+PARTIALS_BY_TYPE['multiple_answers'] = SimpleCounts